@@ -0,0 +1,94 @@
+"""مقایسه سرعت درج گروهی فایل‌ها (COPY) با روش قدیمی درج تک‌به‌تک
+
+اجرا:
+    DATABASE_URL=postgres://... python benchmarks/bench_add_files.py
+
+روی یک دیتابیس آزمایشی اجرا شود؛ دسته‌های ساخته‌شده در پایان حذف می‌شوند.
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+
+from common import load_bot_module
+
+BATCH_SIZES = [10, 100, 1000]
+ROUNDS = int(os.getenv('BENCH_ROUNDS', '3'))
+
+
+def make_files(count: int) -> list:
+    """ساخت فایل‌های ساختگی"""
+    return [
+        {
+            'file_id': f"bench_{uuid.uuid4().hex}",
+            'file_unique_id': f"bench_{uuid.uuid4().hex}",
+            'file_name': f"file_{i}.bin",
+            'file_size': 1024 * i,
+            'file_type': 'document',
+            'caption': f"caption {i}"
+        }
+        for i in range(count)
+    ]
+
+
+async def legacy_add_files(pool, category_id: str, files: list) -> int:
+    """روش قبلی: یک INSERT برای هر فایل بدون تراکنش"""
+    async with pool.acquire() as conn:
+        inserted_count = 0
+        for f in files:
+            await conn.execute(
+                "INSERT INTO media(file_unique_id, file_id, file_name, file_size, file_type) "
+                "VALUES($1, $2, $3, $4, $5) ON CONFLICT (file_unique_id) DO NOTHING",
+                f['file_unique_id'],
+                f['file_id'],
+                f['file_name'],
+                f['file_size'],
+                f['file_type']
+            )
+            result = await conn.execute(
+                "INSERT INTO category_files(category_id, file_unique_id, caption) "
+                "VALUES($1, $2, $3) ON CONFLICT (category_id, file_unique_id) DO NOTHING",
+                category_id,
+                f['file_unique_id'],
+                f.get('caption', '')
+            )
+            inserted_count += int(result.split()[-1])
+        return inserted_count
+
+
+async def measure(func, category_id: str, count: int) -> float:
+    """میانگین زمان اجرای یک روش درج (میلی‌ثانیه)"""
+    total = 0.0
+    for _ in range(ROUNDS):
+        files = make_files(count)
+        started = time.perf_counter()
+        inserted = await func(category_id, files)
+        total += time.perf_counter() - started
+        assert inserted == count, f"expected {count}, inserted {inserted}"
+    return total / ROUNDS * 1000
+
+
+async def main():
+    if not os.getenv('DATABASE_URL'):
+        sys.exit("DATABASE_URL is not set")
+
+    bot = load_bot_module()
+    db = bot.Database()
+    await db.connect()
+
+    category_id = await db.add_category(f"bench_{uuid.uuid4().hex[:8]}", 0)
+    try:
+        print(f"{'files':>6} | {'loop (ms)':>10} | {'bulk (ms)':>10} | {'speedup':>7}")
+        for count in BATCH_SIZES:
+            legacy = await measure(
+                lambda cid, files: legacy_add_files(db.pool, cid, files), category_id, count)
+            bulk = await measure(db.add_files, category_id, count)
+            print(f"{count:>6} | {legacy:>10.1f} | {bulk:>10.1f} | {legacy / bulk:>6.1f}x")
+    finally:
+        await db.delete_category(category_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
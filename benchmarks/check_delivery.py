@@ -0,0 +1,102 @@
+"""بررسی سرتاسری ارسال یک دسته: صف ارسال، worker و Bot API ساختگی
+
+یک دسته با انواع مختلف فایل (آلبوم عکس/ویدیو، سند، صوت) ساخته می‌شود،
+ارسال آن برای یک کاربر در صف قرار می‌گیرد و پس از تخلیه صف تعداد فایل‌هایی
+که Bot API ساختگی واقعا دریافت کرده با تعداد فایل‌های دسته مقایسه می‌شود.
+در صورت عدم تطابق با کد خروج 1 تمام می‌شود.
+
+اجرا:
+    python benchmarks/check_delivery.py
+    DATABASE_URL=postgres://... python benchmarks/check_delivery.py --files 120
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from load_test import (
+    BOT_TOKEN, ADMIN_ID, FIRST_USER_ID, FakeBotAPI, TempPostgres, wait_for_deliveries
+)
+
+FILE_TYPES = ('photo', 'photo', 'video', 'document', 'document', 'audio')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end delivery check for uploader-bot.py")
+    parser.add_argument('--files', type=int, default=23, help="files in the test category")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="probability of a 429 RetryAfter on send* calls")
+    args = parser.parse_args()
+    # تنظیمات ثابت Bot API ساختگی
+    args.latency, args.jitter, args.retry_after, args.member_rate = 0.001, 0.0, 1, 1.0
+    return args
+
+
+async def main() -> int:
+    args = parse_args()
+
+    postgres = None
+    if not os.getenv('DATABASE_URL'):
+        postgres = TempPostgres()
+        os.environ['DATABASE_URL'] = postgres.start()
+
+    os.environ['BOT_TOKEN'] = BOT_TOKEN
+    os.environ['ADMIN_IDS'] = str(ADMIN_ID)
+
+    from common import load_bot_module
+    from telegram.ext import Application
+
+    fake_api = FakeBotAPI(args)
+    api_runner, base_url = await fake_api.start()
+    bot = load_bot_module()
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(base_url)
+        .request(bot.InstrumentedRequest(connection_pool_size=16))
+        .updater(None)
+        .build()
+    )
+    try:
+        await application.initialize()
+        await bot.bot_manager.init(application.bot.username)
+        bot.bot_manager.deliveries.start(application.bot, bot.deliver_category)
+        db = bot.bot_manager.db
+
+        category_id = await db.add_category(f"check_{time.time_ns()}", ADMIN_ID)
+        await db.add_files(category_id, [
+            {
+                'file_id': f"check_{category_id}_{i}",
+                'file_unique_id': f"check_{category_id}_{i}",
+                'file_name': f"check_{i}.bin",
+                'file_size': 1024,
+                'file_type': FILE_TYPES[i % len(FILE_TYPES)],
+                'caption': f"file {i}"
+            }
+            for i in range(args.files)
+        ])
+
+        await bot.bot_manager.deliveries.enqueue(FIRST_USER_ID, category_id)
+        await wait_for_deliveries(db)
+        cursor = await db.get_delivery_cursor(FIRST_USER_ID, category_id)
+        await db.delete_category(category_id)
+
+        print(f"Bot API calls: {fake_api.calls}")
+        if fake_api.delivered != args.files or cursor:
+            print(f"FAIL: delivered {fake_api.delivered}/{args.files} files, cursor left at {cursor}")
+            return 1
+        print(f"OK: delivered {fake_api.delivered}/{args.files} files")
+        return 0
+    finally:
+        await bot.bot_manager.deliveries.stop()
+        await application.shutdown()
+        await bot.bot_manager.db.close()
+        await api_runner.cleanup()
+        if postgres:
+            postgres.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,12 @@
+"""ابزارهای مشترک اسکریپت‌های بنچمارک"""
+import os
+import importlib.util
+
+
+def load_bot_module():
+    """بارگذاری uploader-bot.py (نام فایل شامل خط تیره است)"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'uploader-bot.py')
+    spec = importlib.util.spec_from_file_location('uploader_bot', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
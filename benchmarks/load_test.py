@@ -0,0 +1,417 @@
+"""بار آزمایی ربات با یک Bot API ساختگی و PostgreSQL محلی
+
+Bot API ساختگی یک سرور aiohttp است که تاخیر، پاسخ RetryAfter و نتیجه
+get_chat_member را شبیه‌سازی می‌کند. هندلرهای start، button_handler و
+handle_file برای هزاران کاربر شبیه‌سازی‌شده اجرا و صدک‌های تاخیر و
+توان عملیاتی گزارش می‌شوند.
+
+اجرا:
+    python benchmarks/load_test.py --users 2000 --concurrency 200
+    DATABASE_URL=postgres://... python benchmarks/load_test.py --scenario start
+
+اگر DATABASE_URL تنظیم نشده باشد، یک کلاستر موقت PostgreSQL با initdb/pg_ctl
+ساخته و در پایان حذف می‌شود (پوشه باینری‌ها را می‌توان با PG_BIN مشخص کرد).
+"""
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from itertools import count
+
+from aiohttp import web
+
+BOT_TOKEN = '123456:LOADTEST'
+ADMIN_ID = 1
+FIRST_USER_ID = 100000
+# متدهایی که یک فایل به کاربر می‌رسانند (sendMediaGroup جداگانه شمرده می‌شود)
+FILE_METHODS = ('sendDocument', 'sendPhoto', 'sendVideo', 'sendAudio')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test for uploader-bot.py")
+    parser.add_argument('--scenario', choices=['start', 'check', 'upload', 'all'], default='all')
+    parser.add_argument('--users', type=int, default=1000, help="simulated users per scenario")
+    parser.add_argument('--concurrency', type=int, default=100, help="updates in flight at once")
+    parser.add_argument('--files', type=int, default=5, help="files in the test category")
+    parser.add_argument('--channels', type=int, default=3, help="required channels")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Bot API latency (seconds)")
+    parser.add_argument('--jitter', type=float, default=0.02, help="random extra latency (seconds)")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="probability of a 429 RetryAfter on send* calls")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after seconds in injected 429s")
+    parser.add_argument('--member-rate', type=float, default=1.0,
+                        help="probability that get_chat_member reports the user as a member")
+    return parser.parse_args()
+
+
+# ========================
+# ==== FAKE BOT API ======
+# ========================
+
+class FakeBotAPI:
+    """شبیه‌ساز Bot API تلگرام"""
+
+    def __init__(self, args):
+        self.args = args
+        self.message_ids = count(1)
+        self.calls = {}
+        self.retry_after_sent = 0
+        self.delivered = 0  # فایل‌های ارسال‌شده با موفقیت (هر عضو آلبوم یک فایل)
+
+    def _message(self, chat_id, text=None) -> dict:
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'text': text
+        }
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        await asyncio.sleep(self.args.latency + random.random() * self.args.jitter)
+
+        if method.startswith('send') and random.random() < self.args.retry_after_rate:
+            self.retry_after_sent += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.args.retry_after}",
+                'parameters': {'retry_after': self.args.retry_after}
+            }, status=429)
+
+        result = self.result(method, params)
+        if method == 'sendMediaGroup':
+            self.delivered += len(result)
+        elif method in FILE_METHODS:
+            self.delivered += 1
+        return web.json_response({'ok': True, 'result': result})
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Load', 'username': 'loadtest_bot'}
+        if method == 'getChatMember':
+            status = 'member' if random.random() < self.args.member_rate else 'left'
+            user = {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'user'}
+            return {'status': status, 'user': user}
+        if method == 'sendMediaGroup':
+            return [self._message(params['chat_id']) for _ in json.loads(params['media'])]
+        if method.startswith('send'):
+            return self._message(params['chat_id'], params.get('text'))
+        if method == 'editMessageText':
+            return self._message(params.get('chat_id', FIRST_USER_ID), params.get('text'))
+        return True
+
+    async def start(self) -> tuple:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner, f"http://127.0.0.1:{port}/bot"
+
+
+# ========================
+# ==== LOCAL POSTGRES ====
+# ========================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TempPostgres:
+    """کلاستر موقت PostgreSQL برای هر اجرا"""
+
+    def __init__(self):
+        bin_dir = os.getenv('PG_BIN', '')
+        self.initdb = os.path.join(bin_dir, 'initdb') if bin_dir else shutil.which('initdb')
+        self.pg_ctl = os.path.join(bin_dir, 'pg_ctl') if bin_dir else shutil.which('pg_ctl')
+        self.data_dir = None
+
+    def start(self) -> str:
+        if not self.initdb or not self.pg_ctl:
+            sys.exit("initdb/pg_ctl not found: set DATABASE_URL or PG_BIN")
+
+        self.data_dir = tempfile.mkdtemp(prefix='bot-loadtest-')
+        port = free_port()
+        subprocess.run(
+            [self.initdb, '-D', self.data_dir, '-U', 'postgres', '-A', 'trust'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        subprocess.run(
+            [self.pg_ctl, '-D', self.data_dir, '-w', '-l', os.path.join(self.data_dir, 'server.log'),
+             '-o', f"-p {port} -k {self.data_dir} -c listen_addresses=127.0.0.1", 'start'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        return f"postgres://postgres@127.0.0.1:{port}/postgres"
+
+    def stop(self):
+        if self.data_dir:
+            subprocess.run([self.pg_ctl, '-D', self.data_dir, '-m', 'fast', 'stop'],
+                           stdout=subprocess.DEVNULL)
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+# ========================
+# ==== UPDATE FACTORY ====
+# ========================
+
+def user_dict(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+
+def message_dict(user_id: int, **fields) -> dict:
+    message = {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user_dict(user_id)
+    }
+    message.update(fields)
+    return message
+
+
+class Scenario:
+    """اجرای یک هندلر برای کاربران شبیه‌سازی‌شده و ثبت تاخیرها"""
+
+    def __init__(self, bot, application, name: str):
+        self.bot = bot
+        self.application = application
+        self.name = name
+        self.update_ids = count(1)
+        self.latencies = []
+        self.errors = 0
+
+    def context(self, update, args=None):
+        from telegram.ext import CallbackContext
+        context = CallbackContext.from_update(update, self.application)
+        context.args = args
+        return context
+
+    def make_update(self, data: dict):
+        from telegram import Update
+        data['update_id'] = next(self.update_ids)
+        return Update.de_json(data, self.application.bot)
+
+    async def call(self, handler, update, args=None):
+        started_at = time.perf_counter()
+        try:
+            await handler(update, self.context(update, args))
+        except Exception as e:
+            self.errors += 1
+            print(f"  {self.name}: {type(e).__name__}: {e}")
+        self.latencies.append(time.perf_counter() - started_at)
+
+    async def run(self, jobs: list, concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(job):
+            async with semaphore:
+                await job()
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(limited(job) for job in jobs))
+        return time.perf_counter() - started_at
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def report(scenario: Scenario, elapsed: float):
+    values = scenario.latencies
+    if not values:
+        return
+    print(
+        f"{scenario.name:>8} | {len(values):>6} | {len(values) / elapsed:>8.1f} | "
+        f"{percentile(values, 50) * 1000:>8.1f} | {percentile(values, 95) * 1000:>8.1f} | "
+        f"{percentile(values, 99) * 1000:>8.1f} | {scenario.errors:>6}"
+    )
+
+
+# ========================
+# ==== SCENARIOS =========
+# ========================
+
+async def run_start(bot, application, category_id: str, args) -> tuple:
+    """باز کردن لینک دسته توسط کاربران"""
+    scenario = Scenario(bot, application, 'start')
+    jobs = []
+    for i in range(args.users):
+        user_id = FIRST_USER_ID + i
+        update = scenario.make_update({'message': message_dict(
+            user_id,
+            text=f"/start cat_{category_id}",
+            entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        )})
+        jobs.append(lambda update=update: scenario.call(bot.start, update, [f"cat_{category_id}"]))
+    return scenario, await scenario.run(jobs, args.concurrency)
+
+
+async def run_check(bot, application, category_id: str, args) -> tuple:
+    """زدن دکمه «عضو شدم» توسط کاربران"""
+    scenario = Scenario(bot, application, 'check_')
+    jobs = []
+    for i in range(args.users):
+        user_id = FIRST_USER_ID + args.users + i
+        update = scenario.make_update({'callback_query': {
+            'id': str(i),
+            'from': user_dict(user_id),
+            'chat_instance': str(user_id),
+            'data': f"check_{category_id}",
+            'message': message_dict(user_id, text="⚠️")
+        }})
+        jobs.append(lambda update=update: scenario.call(bot.button_handler, update))
+    return scenario, await scenario.run(jobs, args.concurrency)
+
+
+async def run_upload(bot, application, category_id: str, args) -> tuple:
+    """ارسال فایل توسط ادمین در نشست آپلود"""
+    scenario = Scenario(bot, application, 'upload')
+    await bot.bot_manager.sessions.start_upload(ADMIN_ID, category_id)
+    jobs = []
+    for i in range(args.users):
+        update = scenario.make_update({'message': message_dict(ADMIN_ID, document={
+            'file_id': f"load_{i}_{time.time_ns()}",
+            'file_unique_id': f"u{i}",
+            'file_name': f"file_{i}.bin",
+            'file_size': 1024
+        })})
+        jobs.append(lambda update=update: scenario.call(bot.handle_file, update))
+    elapsed = await scenario.run(jobs, args.concurrency)
+    await bot.bot_manager.sessions.cancel_upload(ADMIN_ID)
+    return scenario, elapsed
+
+
+async def wait_for_deliveries(db, timeout: float = 120):
+    """انتظار برای خالی شدن صف ارسال تا آمار Bot API کامل باشد"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with db.acquire() as conn:
+            pending = await conn.fetchval("SELECT COUNT(*) FROM delivery_jobs")
+        if not pending:
+            return
+        await asyncio.sleep(0.5)
+    print(f"Delivery queue not drained after {timeout:.0f}s")
+
+
+def check_delivered(fake_api: FakeBotAPI, queued: int, args) -> bool:
+    """مقایسه فایل‌های رسیده به Bot API با تعداد کارهای ارسال ثبت‌شده × --files"""
+    expected = queued * args.files
+    print(f"Delivered files: {fake_api.delivered} / {expected} expected ({queued} deliveries x {args.files} files)")
+    ok = fake_api.delivered == expected
+    if not ok:
+        print("FAIL: delivered files do not match the queued deliveries")
+    # با عضویت قطعی همه کاربران start و check باید ارسال دریافت کنند
+    delivering = sum(1 for name in ('start', 'check') if args.scenario in (name, 'all'))
+    if args.member_rate >= 1 and queued != args.users * delivering:
+        print(f"WARNING: {queued} deliveries queued, expected {args.users * delivering}")
+    return ok
+
+
+async def main() -> int:
+    args = parse_args()
+
+    postgres = None
+    if not os.getenv('DATABASE_URL'):
+        postgres = TempPostgres()
+        os.environ['DATABASE_URL'] = postgres.start()
+
+    # تنظیمات ربات باید پیش از بارگذاری ماژول مشخص شوند
+    os.environ['BOT_TOKEN'] = BOT_TOKEN
+    os.environ['ADMIN_IDS'] = str(ADMIN_ID)
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(min(args.concurrency, 50)))
+
+    from common import load_bot_module
+    from telegram.ext import Application
+
+    fake_api = FakeBotAPI(args)
+    api_runner, base_url = await fake_api.start()
+    bot = load_bot_module()
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(base_url)
+        .request(bot.InstrumentedRequest(connection_pool_size=256))
+        .updater(None)
+        .build()
+    )
+    try:
+        await application.initialize()
+        await bot.bot_manager.init(application.bot.username)
+        bot.bot_manager.deliveries.start(application.bot, bot.deliver_category)
+        db = bot.bot_manager.db
+        
+        # شمارش کارهای ارسال ثبت‌شده برای مقایسه با فایل‌های رسیده به Bot API
+        queued = 0
+        enqueue = bot.bot_manager.deliveries.enqueue
+        
+        async def counting_enqueue(chat_id, category_id):
+            nonlocal queued
+            added = await enqueue(chat_id, category_id)
+            queued += added
+            return added
+        bot.bot_manager.deliveries.enqueue = counting_enqueue
+
+        category_id = await db.add_category(f"loadtest_{time.time_ns()}", ADMIN_ID)
+        await db.add_files(category_id, [
+            {
+                'file_id': f"seed_{category_id}_{i}",
+                'file_unique_id': f"seed_{category_id}_{i}",
+                'file_name': f"seed_{i}.bin",
+                'file_size': 1024,
+                'file_type': 'document',
+                'caption': f"file {i}"
+            }
+            for i in range(args.files)
+        ])
+        channel_ids = [f"-100{category_id}{i}" for i in range(args.channels)]
+        for i, channel_id in enumerate(channel_ids):
+            await db.add_channel(channel_id, f"channel {i}", f"https://t.me/+loadtest{i}")
+
+        scenarios = ['start', 'check', 'upload'] if args.scenario == 'all' else [args.scenario]
+        runners = {'start': run_start, 'check': run_check, 'upload': run_upload}
+
+        print(f"{'scenario':>8} | {'count':>6} | {'per sec':>8} | {'p50 ms':>8} | "
+              f"{'p95 ms':>8} | {'p99 ms':>8} | {'errors':>6}")
+        for name in scenarios:
+            scenario, elapsed = await runners[name](bot, application, category_id, args)
+            report(scenario, elapsed)
+        await wait_for_deliveries(db)
+
+        print(f"\nBot API calls: {json.dumps(fake_api.calls, sort_keys=True)}")
+        print(f"Injected RetryAfter: {fake_api.retry_after_sent}")
+        print(f"Delivery: {bot.bot_manager.delivery.stats()}")
+        print(f"Membership cache: {bot.bot_manager.membership_cache.stats()}")
+        ok = check_delivered(fake_api, queued, args)
+
+        for channel_id in channel_ids:
+            await db.delete_channel(channel_id)
+        await db.delete_category(category_id)
+        return 0 if ok else 1
+    finally:
+        await bot.bot_manager.deliveries.stop()
+        await application.shutdown()
+        await bot.bot_manager.db.close()
+        await api_runner.cleanup()
+        if postgres:
+            postgres.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -1,13 +1,41 @@
 import os
+import hashlib
 import logging
 import uuid
+import functools
+import contextlib
+import json
+import random
+import signal
+import sys
+import hmac
+import threading
+import contextvars
+import bisect
+import heapq
+import time
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+from telegram import (
+    Bot,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    Message,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaDocument,
+    InputMediaAudio
+)
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     filters,
     ConversationHandler
@@ -20,6 +48,86 @@ import aiohttp
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
+# حالت وب‌هوک (در صورت تنظیم WEBHOOK_URL به جای polling استفاده می‌شود)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# مقدار پیش‌فرض از توکن ساخته می‌شود تا در همه نمونه‌های پشت load balancer یکسان باشد
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256((BOT_TOKEN or '').encode()).hexdigest()
+MEMBERSHIP_CACHE_TTL = int(os.getenv('MEMBERSHIP_CACHE_TTL', '300'))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '50000'))
+MEMBERSHIP_CHECK_CONCURRENCY = int(os.getenv('MEMBERSHIP_CHECK_CONCURRENCY', '10'))
+# محدودیت درخواست هر کاربر برای لینک دسته‌ها و دکمه "عضو شدم" (درخواست در ثانیه)
+USER_RATE = float(os.getenv('USER_RATE', '0.5'))
+USER_BURST = int(os.getenv('USER_BURST', '5'))
+# نگهداری عضویت‌ها از آپدیت‌های chat_member (ربات باید در کانال‌ها ادمین باشد)
+MEMBERSHIP_UPDATES = os.getenv('MEMBERSHIP_UPDATES', '0') == '1'
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', '1000'))
+# تنظیمات pool اتصال‌های دیتابیس
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '5'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '20'))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_MAX_INACTIVE_LIFETIME', '300'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '10'))
+# محدودیت‌های ارسال تلگرام (پیام در ثانیه)
+DELIVERY_GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', '25'))
+DELIVERY_CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', '1'))
+DELIVERY_CHAT_BURST = int(os.getenv('DELIVERY_CHAT_BURST', '5'))
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', '5'))
+DELIVERY_MEDIA_GROUPS = os.getenv('DELIVERY_MEDIA_GROUPS', '1') == '1'
+DELIVERY_PAGE_SIZE = int(os.getenv('DELIVERY_PAGE_SIZE', '50'))
+CATEGORIES_PAGE_SIZE = int(os.getenv('CATEGORIES_PAGE_SIZE', '10'))
+DELIVERY_PAGE_BUTTON = os.getenv('DELIVERY_PAGE_BUTTON', '0') == '1'
+DELIVERY_RESUME_WINDOW = int(os.getenv('DELIVERY_RESUME_WINDOW', '3600'))
+# صف پایدار ارسال: تعداد worker این پروسه (0 = فقط دریافت آپدیت و ارسال توسط پروسه‌ای با BOT_MODE=worker)
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '4'))
+DELIVERY_JOB_LEASE = int(os.getenv('DELIVERY_JOB_LEASE', '120'))
+DELIVERY_JOB_MAX_ATTEMPTS = int(os.getenv('DELIVERY_JOB_MAX_ATTEMPTS', '3'))
+DELIVERY_POLL_INTERVAL = float(os.getenv('DELIVERY_POLL_INTERVAL', '2'))
+# دسته‌های پرطرفدار: شمارش ارسال‌های برداشته‌شده از صف در پنجره زمانی و نگهداری برنامه ارسال آماده برای K دسته اول
+# (حد HOT_CATEGORY_MIN_OPENS برای کل ربات است و بین SHARED_PROCESSES پروسه تقسیم می‌شود)
+HOT_CATEGORY_WINDOW = int(os.getenv('HOT_CATEGORY_WINDOW', '300'))
+HOT_CATEGORY_TOP_K = int(os.getenv('HOT_CATEGORY_TOP_K', '10'))
+HOT_CATEGORY_MIN_OPENS = int(os.getenv('HOT_CATEGORY_MIN_OPENS', '20'))
+HOT_CATEGORY_MAX_FILES = int(os.getenv('HOT_CATEGORY_MAX_FILES', '5000'))
+# فاصله بررسی سلامت اتصال LISTEN و انتظار قبل از اتصال مجدد (ثانیه)
+DB_LISTENER_CHECK_INTERVAL = float(os.getenv('DB_LISTENER_CHECK_INTERVAL', '30'))
+DB_LISTENER_RETRY = float(os.getenv('DB_LISTENER_RETRY', '5'))
+# all: ربات کامل | worker: فقط تخلیه صف ارسال | supervisor: تقسیم وبهوک بین چند پروسه shard
+BOT_MODE = os.getenv('BOT_MODE', 'all')
+BOT_PROCESSES = int(os.getenv('BOT_PROCESSES', str(os.cpu_count() or 1)))
+# پروسه‌های shard روی 127.0.0.1 و پورت SHARD_BASE_PORT + SHARD_INDEX آپدیت دریافت می‌کنند
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', '10100'))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+# تعداد پروسه‌هایی که بودجه سراسری ارسال (DELIVERY_GLOBAL_RATE) و اتصال‌های دیتابیس (DB_POOL_MAX_SIZE) را بین خود تقسیم می‌کنند
+# 0 = در حالت shard برابر BOT_PROCESSES و در غیر این صورت 1؛ با پروسه‌های BOT_MODE=worker جداگانه
+# باید در همه پروسه‌ها برابر تعداد کل پروسه‌های ارسال‌کننده تنظیم شود
+SHARED_PROCESSES = int(os.getenv('SHARED_PROCESSES', '0')) or (BOT_PROCESSES if BOT_MODE == 'shard' else 1)
+# پورت سرور وب (برای اجرای چند پروسه worker روی یک ماشین متفاوت تنظیم شود)
+WEB_PORT = int(os.getenv('WEB_PORT', '10000'))
+# کلاینت HTTP مشترک برای درخواست‌های خروجی
+HTTP_CLIENT_POOL_SIZE = int(os.getenv('HTTP_CLIENT_POOL_SIZE', '20'))
+HTTP_CLIENT_TIMEOUT = float(os.getenv('HTTP_CLIENT_TIMEOUT', '30'))
+# پینگ دوره‌ای برای جلوگیری از خوابیدن سرویس (آدرس خالی = غیرفعال)
+KEEP_ALIVE_URL = os.getenv(
+    'KEEP_ALIVE_URL',
+    f"{os.getenv('RENDER_EXTERNAL_URL', 'https://uploader-bot-ely6.onrender.com').rstrip('/')}/health"
+)
+KEEP_ALIVE_INTERVAL = float(os.getenv('KEEP_ALIVE_INTERVAL', '450'))
+KEEP_ALIVE_JITTER = float(os.getenv('KEEP_ALIVE_JITTER', '0.1'))
+# حداکثر زمان انتظار برای تکمیل ارسال‌های در جریان هنگام توقف (ثانیه)
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '20'))
+# ثبت مراحل اجرای هر آپدیت و لاگ آپدیت‌های کندتر از SLOW_UPDATE_THRESHOLD ثانیه
+PROFILE_UPDATES = os.getenv('PROFILE_UPDATES', '0') == '1'
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', '2'))
+# توکن دسترسی به مسیرهای /debug (خالی = غیرفعال)
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')
+# ذخیره‌ساز نشست‌های آپلود و افزودن کانال: postgres یا memory
+SESSION_STORE = os.getenv('SESSION_STORE', 'postgres')
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+# فاصله حداقل بین ویرایش پیام وضعیت آپلود و زمان انتظار برای تکمیل آلبوم (ثانیه)
+UPLOAD_ACK_INTERVAL = float(os.getenv('UPLOAD_ACK_INTERVAL', '3'))
+UPLOAD_ALBUM_WAIT = float(os.getenv('UPLOAD_ALBUM_WAIT', '1'))
 
 # تنظیمات لاگ
 logging.basicConfig(
@@ -31,20 +139,716 @@ logger = logging.getLogger(__name__)
 # حالت‌های گفتگو
 UPLOADING, WAITING_CHANNEL_INFO = range(2)
 
+_MISSING = object()
+
+# انواع قابل ارسال در آلبوم و گروه‌های سازگار (عکس و ویدیو می‌توانند در یک آلبوم باشند)
+MEDIA_GROUP_TYPES = {
+    'photo': ('visual', InputMediaPhoto),
+    'video': ('visual', InputMediaVideo),
+    'document': ('document', InputMediaDocument),
+    'audio': ('audio', InputMediaAudio)
+}
+MEDIA_GROUP_MAX_SIZE = 10
+# متد Bot API ارسال تکی هر نوع فایل (یک بار در سطح ماژول، نه برای هر فایل)
+SEND_METHODS = {
+    'document': 'send_document',
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'audio': 'send_audio'
+}
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# یک مرحله ارسال: last_id برای ذخیره پیشرفت، album (InputMediaها یا None)، singles برای ارسال تکی و ids شناسه فایل‌ها
+DeliveryStep = namedtuple('DeliveryStep', 'last_id album singles ids')
+# برنامه کامل ارسال یک دسته؛ last_ids برای پیدا کردن محل ادامه با bisect
+DeliveryPlan = namedtuple('DeliveryPlan', 'name file_count steps last_ids')
+
+# کوئری‌های پرتکرار (asyncpg آن‌ها را به صورت prepared statement در هر اتصال کش می‌کند)
+FILES_PAGE_SQL = '''
+    SELECT cf.id, m.file_id, m.file_type, cf.caption
+    FROM category_files cf
+    JOIN media m ON m.file_unique_id = cf.file_unique_id
+    WHERE cf.category_id = $1 AND cf.id > $2
+    ORDER BY cf.id
+    LIMIT $3
+'''
+
+CATEGORY_SUMMARY_SQL = '''
+    SELECT name, file_count, total_bytes
+    FROM categories
+    WHERE id = $1
+'''
+
+# نگهداری تعداد و حجم فایل‌های هر دسته با تریگرهای سطح statement (یک UPDATE برای هر دسته در هر درج گروهی)
+CATEGORY_COUNTERS_SQL = '''
+    CREATE OR REPLACE FUNCTION category_files_counters_insert() RETURNS trigger AS $$
+    BEGIN
+        UPDATE categories c
+        SET file_count = c.file_count + n.files, total_bytes = c.total_bytes + n.bytes
+        FROM (
+            SELECT r.category_id, COUNT(*) AS files, COALESCE(SUM(m.file_size), 0) AS bytes
+            FROM new_rows r JOIN media m ON m.file_unique_id = r.file_unique_id
+            GROUP BY r.category_id
+        ) n
+        WHERE c.id = n.category_id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION category_files_counters_delete() RETURNS trigger AS $$
+    BEGIN
+        UPDATE categories c
+        SET file_count = c.file_count - o.files, total_bytes = c.total_bytes - o.bytes
+        FROM (
+            SELECT r.category_id, COUNT(*) AS files, COALESCE(SUM(m.file_size), 0) AS bytes
+            FROM old_rows r JOIN media m ON m.file_unique_id = r.file_unique_id
+            GROUP BY r.category_id
+        ) o
+        WHERE c.id = o.category_id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS category_files_counters_insert ON category_files;
+    CREATE TRIGGER category_files_counters_insert AFTER INSERT ON category_files
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION category_files_counters_insert();
+
+    DROP TRIGGER IF EXISTS category_files_counters_delete ON category_files;
+    CREATE TRIGGER category_files_counters_delete AFTER DELETE ON category_files
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION category_files_counters_delete();
+'''
+
+# محاسبه دوباره شمارنده‌های همه دسته‌ها از روی داده‌ها
+RECOUNT_CATEGORIES_SQL = '''
+    UPDATE categories c
+    SET file_count = s.files, total_bytes = s.bytes
+    FROM (
+        SELECT cf.category_id, COUNT(*) AS files, COALESCE(SUM(m.file_size), 0) AS bytes
+        FROM category_files cf JOIN media m ON m.file_unique_id = cf.file_unique_id
+        GROUP BY cf.category_id
+    ) s
+    WHERE c.id = s.category_id
+'''
+
+CHANNELS_SQL = "SELECT channel_id, channel_name, invite_link FROM channels"
+
+# برداشتن کار بعدی صف ارسال؛ $2 تعداد کارها (۱ برای برداشتن، ۰ برای آماده‌سازی بدون تغییر صف)
+# first_claim فقط در اولین برداشتن کار True است (تلاش‌های مجدد و leaseهای منقضی‌شده را شامل نمی‌شود)
+CLAIM_DELIVERY_JOB_SQL = '''
+    UPDATE delivery_jobs j
+    SET locked_until = NOW() + make_interval(secs => $1), attempts = j.attempts + 1,
+        first_claimed_at = COALESCE(j.first_claimed_at, NOW())
+    FROM (
+        SELECT id, first_claimed_at FROM delivery_jobs
+        WHERE available_at <= NOW() AND (locked_until IS NULL OR locked_until < NOW())
+        ORDER BY available_at, id
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE j.id = c.id
+    RETURNING j.id, j.chat_id, j.category_id, j.attempts, c.first_claimed_at IS NULL AS first_claim
+'''
+
+# کانال NOTIFY برای باطل کردن کش همه پروسه‌ها؛ payload: لیست JSON کلیدهای کش
+CACHE_CHANNEL = 'bot_cache_invalidation'
+
+# تریگرهایی که با هر تغییر در دسته‌ها، فایل‌های دسته و کانال‌ها کلیدهای کش مربوط را اعلام می‌کنند
+CACHE_NOTIFY_SQL = f'''
+    CREATE OR REPLACE FUNCTION notify_category_change() RETURNS trigger AS $$
+    DECLARE
+        changed_id TEXT := CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END;
+    BEGIN
+        PERFORM pg_notify('{CACHE_CHANNEL}', json_build_array(
+            json_build_array('summary', changed_id)
+        )::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION notify_category_files_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CACHE_CHANNEL}', json_build_array(
+            json_build_array('summary', c.category_id)
+        )::text)
+        FROM (SELECT DISTINCT category_id FROM changed_rows) c;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION notify_channels_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CACHE_CHANNEL}', json_build_array(json_build_array('channels'))::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS categories_notify ON categories;
+    CREATE TRIGGER categories_notify AFTER INSERT OR UPDATE OR DELETE ON categories
+        FOR EACH ROW EXECUTE FUNCTION notify_category_change();
+
+    DROP TRIGGER IF EXISTS category_files_notify_insert ON category_files;
+    CREATE TRIGGER category_files_notify_insert AFTER INSERT ON category_files
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_category_files_change();
+
+    DROP TRIGGER IF EXISTS category_files_notify_update ON category_files;
+    CREATE TRIGGER category_files_notify_update AFTER UPDATE ON category_files
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_category_files_change();
+
+    DROP TRIGGER IF EXISTS category_files_notify_delete ON category_files;
+    CREATE TRIGGER category_files_notify_delete AFTER DELETE ON category_files
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_category_files_change();
+
+    DROP TRIGGER IF EXISTS channels_notify ON channels;
+    CREATE TRIGGER channels_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON channels
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_channels_change();
+'''
+
+# کوئری‌هایی که روی هر اتصال جدید از قبل آماده می‌شوند (با آرگومان‌های بی‌اثر)
+HOT_STATEMENTS = [
+    (CATEGORY_SUMMARY_SQL, ('',)),
+    (FILES_PAGE_SQL, ('', 0, 1)),
+    (CHANNELS_SQL, ()),
+    (CLAIM_DELIVERY_JOB_SQL, (0, 0))
+]
+
+class TTLCache:
+    """کش LRU با محدودیت اندازه، انقضای زمانی و آمار hit/miss"""
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (value, expires_at)}
+    
+    def get(self, key, default=None):
+        """دریافت مقدار از کش (مقادیر منقضی‌شده حذف می‌شوند)"""
+        item = self._data.get(key, _MISSING)
+        if item is not _MISSING:
+            value, expires_at = item
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+    
+    def set(self, key, value):
+        """ذخیره مقدار و حذف قدیمی‌ترین آیتم در صورت پر شدن کش"""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        """حذف یک کلید از کش"""
+        self._data.pop(key, None)
+    
+    def clear(self):
+        """خالی کردن کامل کش"""
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        """آمار استفاده از کش"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# مرزهای پیش‌فرض هیستوگرام‌ها (ثانیه)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    """ثبت ساده متریک‌ها (counter، histogram و gauge) با خروجی متنی Prometheus"""
+    
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # {name: {labels: value}}
+        self.histograms = {}  # {name: {labels: [bucket counts..., sum, count]}}
+        self.gauges = {}  # {name: func() -> float}
+        self.help = {}
+    
+    def describe(self, name: str, text: str):
+        """توضیح متریک برای خروجی HELP"""
+        self.help[name] = text
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """افزایش یک counter"""
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, **labels):
+        """ثبت یک مقدار در هیستوگرام"""
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+    
+    def gauge(self, name: str, func):
+        """ثبت gauge که مقدارش هنگام خواندن محاسبه می‌شود"""
+        self.gauges[name] = func
+    
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}' if parts else ''
+    
+    def render(self) -> str:
+        """تولید خروجی متنی برای /metrics"""
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        
+        for name, series in self.histograms.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, counts in series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {counts[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {counts[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {counts[-1]}")
+        
+        for name, func in self.gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"خطا در محاسبه متریک {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', "Update handler latency by command or callback prefix")
+metrics.describe('bot_db_acquire_seconds', "Time spent waiting for an asyncpg pool connection")
+metrics.describe('bot_telegram_request_seconds', "Bot API call latency by method")
+metrics.describe('bot_telegram_errors_total', "Failed Bot API calls by method and status")
+metrics.describe('bot_telegram_retry_after_total', "Bot API calls rejected with RetryAfter (HTTP 429)")
+metrics.describe('bot_files_delivered_total', "Files delivered to users")
+metrics.describe('bot_delivery_jobs_total', "Finished delivery jobs by result")
+metrics.describe('bot_membership_check_seconds', "Duration of get_chat_member membership checks")
+metrics.describe('bot_membership_cache_hits_total', "Membership checks answered from the cache")
+metrics.describe('bot_membership_cache_misses_total', "Membership checks sent to get_chat_member")
+metrics.describe('bot_slow_updates_total', "Updates slower than SLOW_UPDATE_THRESHOLD by handler")
+metrics.describe('bot_user_throttled_total', "Updates dropped by the per-user rate limit")
+metrics.describe('bot_coalesced_requests_total', "Duplicate category requests joined to one in progress")
+
+# ========================
+# ===== PROFILING ========
+# ========================
+
+# trace آپدیتی که در حال پردازش است (در تسک‌های فرزند هم در دسترس است)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+# آخرین آپدیت‌های کند برای مسیر /debug/slow-updates
+slow_traces = deque(maxlen=50)
+
+class UpdateTrace:
+    """مراحل اجرای یک آپدیت (کوئری‌ها، درخواست‌های Bot API و انتظارها)"""
+    
+    MAX_SPANS = 500
+    
+    def __init__(self, handler: str, update: Update):
+        self.handler = handler
+        self.update_id = update.update_id
+        self.user_id = update.effective_user.id if update.effective_user else None
+        self.started_at = time.perf_counter()
+        self.spans = []  # [(name, start, end)]
+        self.dropped = 0
+    
+    def add(self, name: str, start: float, end: float):
+        if len(self.spans) < self.MAX_SPANS:
+            self.spans.append((name, start, end))
+        else:
+            self.dropped += 1
+    
+    def finish(self):
+        """ثبت trace در صورت کند بودن آپدیت"""
+        elapsed = time.perf_counter() - self.started_at
+        if elapsed < SLOW_UPDATE_THRESHOLD:
+            return
+        record = self.to_dict(elapsed)
+        slow_traces.append(record)
+        metrics.inc('bot_slow_updates_total', handler=self.handler)
+        logger.warning(f"🐢 Slow update: {json.dumps(record, ensure_ascii=False)}")
+    
+    def to_dict(self, elapsed: float) -> dict:
+        stages = {}
+        for name, start, end in self.spans:
+            stage = stages.setdefault(name, {'count': 0, 'total_ms': 0.0})
+            stage['count'] += 1
+            stage['total_ms'] += (end - start) * 1000
+        return {
+            'handler': self.handler,
+            'update_id': self.update_id,
+            'user_id': self.user_id,
+            'duration_ms': round(elapsed * 1000, 1),
+            'stages': {name: {'count': v['count'], 'total_ms': round(v['total_ms'], 1)} for name, v in stages.items()},
+            'spans': [
+                {
+                    'name': name,
+                    'start_ms': round((start - self.started_at) * 1000, 1),
+                    'duration_ms': round((end - start) * 1000, 1)
+                }
+                for name, start, end in self.spans
+            ],
+            'dropped_spans': self.dropped
+        }
+
+class Span:
+    """ثبت زمان یک مرحله در trace آپدیت جاری؛ بدون trace فعال هزینه‌ای ندارد"""
+    
+    __slots__ = ('name', 'trace', 'started_at')
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.trace = current_trace.get()
+    
+    async def __aenter__(self):
+        if self.trace is not None:
+            self.started_at = time.perf_counter()
+    
+    async def __aexit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.started_at, time.perf_counter())
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> dict:
+    """نمونه‌برداری دوره‌ای از پشته یک thread؛ خروجی: {پشته فشرده: تعداد}"""
+    samples = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            samples[key] = samples.get(key, 0) + 1
+        time.sleep(interval)
+    return samples
+
+class TokenBucket:
+    """سطل توکن برای محدود کردن نرخ درخواست‌ها"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def block(self, seconds: float):
+        """توقف کامل سطل تا زمان مشخص (برای RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+    
+    def try_acquire(self) -> bool:
+        """برداشتن یک توکن بدون انتظار؛ False اگر سطل خالی باشد"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    async def acquire(self):
+        """منتظر ماندن تا آزاد شدن یک توکن"""
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                async with Span('sleep.retry_after'):
+                    await asyncio.sleep(self.blocked_until - now)
+                continue
+            
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            async with Span('sleep.rate_limit'):
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DeliveryScheduler:
+    """زمان‌بندی ارسال پیام‌ها با محدودیت سراسری و محدودیت هر چت"""
+    
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # سطل‌های چت‌های غیرفعال پس از یک دقیقه حذف می‌شوند
+        self.chat_buckets = TTLCache(maxsize=100000, ttl=60)
+        self.sent = 0
+        self.failed = 0
+        self.retry_after_count = 0
+        self.active_deliveries = 0
+        self._sent_times = deque()  # زمان ارسال‌های یک دقیقه اخیر
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # تمدید زمان انقضا با هر استفاده
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+    
+    async def send(self, chat_id, send_func, /, *args, **kwargs):
+        """ارسال یک درخواست با رعایت محدودیت‌ها و تلاش مجدد دقیق پس از RetryAfter
+
+        chat_id و send_func فقط موقعیتی‌اند تا chat_id=... به خود متد Bot برسد.
+        """
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(DELIVERY_MAX_RETRIES + 1):
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                result = await send_func(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_count += 1
+                if attempt == DELIVERY_MAX_RETRIES:
+                    self.failed += 1
+                    raise
+                logger.warning(f"RetryAfter {e.retry_after}s برای چت {chat_id}")
+                # محدودیت Flood کل ربات را متوقف می‌کند، نه فقط این چت را
+                self.global_bucket.block(float(e.retry_after))
+                continue
+            except Exception:
+                self.failed += 1
+                raise
+            self._record_sent()
+            return result
+    
+    def _record_sent(self):
+        now = time.monotonic()
+        self.sent += 1
+        self._sent_times.append(now)
+        while self._sent_times and self._sent_times[0] < now - 60:
+            self._sent_times.popleft()
+    
+    def throughput(self) -> float:
+        """میانگین ارسال در ثانیه طی یک دقیقه اخیر"""
+        now = time.monotonic()
+        while self._sent_times and self._sent_times[0] < now - 60:
+            self._sent_times.popleft()
+        return len(self._sent_times) / 60
+    
+    def stats(self) -> dict:
+        """آمار ارسال"""
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retry_after_count,
+            'active_deliveries': self.active_deliveries,
+            'throughput': self.throughput()
+        }
+
 class Database:
     """مدیریت دیتابیس PostgreSQL بهینه‌شده"""
     
     def __init__(self):
         self.pool = None
+        # اتصال جداگانه برای LISTEN (اتصال‌های pool نباید listener نگه دارند)
+        self.listener = None
+        self.listener_task = None
+        # توابعی که با باطل شدن هر کلید کش صدا زده می‌شوند (None یعنی کل کش)
+        self.invalidation_callbacks = []
+        self.schema_ready = False
+        # کش خواندنی برای جداول کم‌تغییر: ('channels',) و ('summary', category_id)
+        self.cache = TTLCache(DB_CACHE_SIZE)
 
     async def connect(self):
         """اتصال به دیتابیس"""
-        self.pool = await asyncpg.create_pool(os.getenv('DATABASE_URL'))
+        # مجموع اتصال‌های همه پروسه‌ها حدود DB_POOL_MAX_SIZE به علاوه یک اتصال LISTEN برای هر پروسه است
+        max_size = max(2, DB_POOL_MAX_SIZE // SHARED_PROCESSES)
+        self.pool = await asyncpg.create_pool(
+            os.getenv('DATABASE_URL'),
+            min_size=min(DB_POOL_MIN_SIZE, max_size),
+            max_size=max_size,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            init=self._init_connection
+        )
         await self.init_db()
+        self.schema_ready = True
+        await self.warm_up()
+        self.listener_task = asyncio.create_task(self._run_listener())
+    
+    async def _run_listener(self):
+        """نگه داشتن اتصال LISTEN برای اعلان‌های تریگرها؛ پس از هر قطع و وصل کل کش پاک می‌شود"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(os.getenv('DATABASE_URL'))
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(CACHE_CHANNEL, self._on_cache_notification)
+                self.listener = conn
+                # اعلان‌های زمان قطع بودن از دست رفته‌اند
+                self._drop_cached(None)
+                logger.info("Cache invalidation listener connected")
+                
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), DB_LISTENER_CHECK_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # قطع شدن بی‌صدای شبکه فقط با یک کوئری مشخص می‌شود
+                        await conn.fetchval("SELECT 1", timeout=5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"اتصال listener کش قطع شد: {e}")
+            finally:
+                self.listener = None
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            
+            self._drop_cached(None)
+            await asyncio.sleep(DB_LISTENER_RETRY)
+    
+    def _on_cache_notification(self, conn, pid, channel, payload):
+        for key in json.loads(payload):
+            self._drop_cached(tuple(key))
+    
+    def _drop_cached(self, key: tuple):
+        """حذف یک کلید (یا با None کل کش) و اطلاع به کش‌های وابسته"""
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
+        for callback in self.invalidation_callbacks:
+            callback(key)
+    
+    async def close(self):
+        """بستن pool؛ اتصال‌هایی که در زمان مقرر آزاد نشوند قطع می‌شوند"""
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            await asyncio.gather(self.listener_task, return_exceptions=True)
+            self.listener_task = None
+        if not self.pool:
+            return
+        self.schema_ready = False
+        try:
+            await asyncio.wait_for(self.pool.close(), 10)
+        except asyncio.TimeoutError:
+            self.pool.terminate()
+    
+    async def _init_connection(self, conn):
+        """آماده‌سازی هر اتصال جدید pool"""
+        if self.schema_ready:
+            await self._prepare_hot_statements(conn)
+    
+    @staticmethod
+    async def _prepare_hot_statements(conn):
+        """اجرای کوئری‌های پرتکرار تا در کش prepared statement اتصال قرار گیرند"""
+        for query, args in HOT_STATEMENTS:
+            await conn.fetch(query, *args)
+    
+    async def warm_up(self):
+        """آماده‌سازی همزمان همه اتصال‌های اولیه pool"""
+        async def prepare():
+            async with self.acquire('db.warm_up') as conn:
+                await self._prepare_hot_statements(conn)
+                # نگه داشتن اتصال تا اتصال‌های دیگر هم گرفته شوند
+                await asyncio.sleep(0.1)
+        
+        await asyncio.gather(*(prepare() for _ in range(self.pool.get_min_size())))
+        logger.info(f"Database pool warmed up ({self.pool.get_size()} connections)")
+    
+    async def health(self) -> dict:
+        """وضعیت آمادگی دیتابیس و میزان اشغال pool"""
+        if not self.pool:
+            return {'ready': False, 'error': 'not connected'}
+        
+        status = {
+            'size': self.pool.get_size(),
+            'max_size': self.pool.get_max_size(),
+            'in_use': self.pool_in_use()
+        }
+        status['saturation'] = status['in_use'] / status['max_size']
+        try:
+            # مهلت کوتاه به جای DB_ACQUIRE_TIMEOUT تا pool پر (مثلا هنگام warm_up) بررسی سلامت را معطل نکند
+            conn = await self.pool.acquire(timeout=1)
+        except asyncio.TimeoutError:
+            # همه اتصال‌ها مشغول کار با دیتابیس‌اند؛ اگر pool پر نباشد اتصال جدید برقرار نمی‌شود
+            status['ready'] = status['in_use'] >= status['max_size']
+            status['error'] = 'pool busy'
+            return status
+        except Exception as e:
+            status['ready'] = False
+            status['error'] = str(e)
+            return status
+        
+        try:
+            await conn.fetchval("SELECT 1", timeout=2)
+            status['ready'] = True
+        except Exception as e:
+            status['ready'] = False
+            status['error'] = str(e)
+        finally:
+            await self.pool.release(conn)
+        return status
+    
+    @contextlib.asynccontextmanager
+    async def acquire(self, span: str = 'db.acquire'):
+        """گرفتن اتصال از pool همراه با ثبت زمان انتظار؛ span نام مرحله در trace آپدیت است"""
+        started_at = time.perf_counter()
+        trace = current_trace.get()
+        # با پر بودن pool به جای انتظار نامحدود خطای TimeoutError رخ می‌دهد
+        async with self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+            metrics.observe('bot_db_acquire_seconds', time.perf_counter() - started_at)
+            if trace is None:
+                yield conn
+                return
+            
+            try:
+                yield conn
+            finally:
+                trace.add(span, started_at, time.perf_counter())
+    
+    def pool_in_use(self) -> int:
+        """تعداد اتصال‌های در حال استفاده"""
+        if not self.pool:
+            return 0
+        return self.pool.get_size() - self.pool.get_idle_size()
     
     async def init_db(self):
         """ایجاد جداول مورد نیاز"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire('db.init_db') as conn:
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS categories (
                     id TEXT PRIMARY KEY,
@@ -54,16 +858,27 @@ class Database:
                 )
             ''')
             
+            # هر محتوا یک بار با file_unique_id تلگرام ذخیره می‌شود
             await conn.execute('''
-                CREATE TABLE IF NOT EXISTS files (
-                    id SERIAL PRIMARY KEY,
-                    category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
-                    file_id TEXT NOT NULL UNIQUE,
+                CREATE TABLE IF NOT EXISTS media (
+                    file_unique_id TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
                     file_name TEXT NOT NULL,
                     file_size BIGINT NOT NULL,
                     file_type TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            
+            # اتصال چند به چند media و دسته‌ها (کپشن برای هر دسته جداست)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS category_files (
+                    id SERIAL PRIMARY KEY,
+                    category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+                    file_unique_id TEXT NOT NULL REFERENCES media(file_unique_id),
                     caption TEXT,
-                    upload_date TIMESTAMP DEFAULT NOW()
+                    added_at TIMESTAMP DEFAULT NOW(),
+                    UNIQUE (category_id, file_unique_id)
                 )
             ''')
             
@@ -77,122 +892,1005 @@ class Database:
                 )
             ''')
             
+            # پیشرفت ارسال هر دسته به هر چت برای ادامه پس از قطع شدن
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS delivery_progress (
+                    chat_id BIGINT NOT NULL,
+                    category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+                    last_file_id INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT NOW(),
+                    PRIMARY KEY (chat_id, category_id)
+                )
+            ''')
+            
+            # عضویت کاربران در کانال‌ها بر اساس آپدیت‌های chat_member
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    channel_id TEXT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    is_member BOOLEAN NOT NULL,
+                    updated_at TIMESTAMP DEFAULT NOW(),
+                    PRIMARY KEY (user_id, channel_id)
+                )
+            ''')
+            
+            # صف ارسال فایل‌ها؛ locked_until خالی یعنی کار در انتظار worker است
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS delivery_jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    locked_until TIMESTAMP,
+                    first_claimed_at TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT NOW(),
+                    UNIQUE (chat_id, category_id)
+                )
+            ''')
+            
             # ایندکس‌های بهینه‌سازی
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_files_category ON files(category_id)')
+            await conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_category_files_category_id ON category_files(category_id, id)'
+            )
+            await conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_category_files_media ON category_files(file_unique_id)'
+            )
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_delivery_jobs_available ON delivery_jobs(available_at, id)')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_categories_created ON categories(created_at, id)')
+            await conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_categories_name_prefix ON categories(lower(name) text_pattern_ops)'
+            )
+            
+            await self._init_category_counters(conn)
+            await self._migrate_legacy_files(conn)
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('cache_notify_triggers'))")
+                await conn.execute(CACHE_NOTIFY_SQL)
             logger.info("Database initialized")
+    
+    async def _init_category_counters(self, conn):
+        """افزودن ستون‌های file_count و total_bytes و تریگرهای نگهداری آن‌ها"""
+        async with conn.transaction():
+            # جلوگیری از اجرای همزمان مهاجرت توسط چند نمونه ربات
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('categories_counters'))")
+            has_counters = await conn.fetchval(
+                "SELECT EXISTS(SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'categories' AND column_name = 'file_count')"
+            )
+            await conn.execute(
+                "ALTER TABLE categories "
+                "ADD COLUMN IF NOT EXISTS file_count INTEGER NOT NULL DEFAULT 0, "
+                "ADD COLUMN IF NOT EXISTS total_bytes BIGINT NOT NULL DEFAULT 0"
+            )
+            await conn.execute(CATEGORY_COUNTERS_SQL)
+            
+            if not has_counters:
+                # مقداردهی اولیه برای دسته‌های موجود
+                await conn.execute(RECOUNT_CATEGORIES_SQL)
+    
+    async def _migrate_legacy_files(self, conn):
+        """انتقال یک‌باره جدول قدیمی files به media و category_files"""
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('files_to_media'))")
+            if await conn.fetchval("SELECT to_regclass('files') IS NULL"):
+                return
+            
+            # فایل‌های قدیمی file_unique_id ندارند؛ file_id به جای آن کلید می‌شود
+            await conn.execute('''
+                INSERT INTO media(file_unique_id, file_id, file_name, file_size, file_type, created_at)
+                SELECT file_id, file_id, file_name, file_size, file_type, upload_date
+                FROM files ORDER BY id
+                ON CONFLICT (file_unique_id) DO NOTHING
+            ''')
+            # شناسه‌ها حفظ می‌شوند تا پیشرفت‌های ذخیره‌شده در delivery_progress معتبر بمانند
+            await conn.execute('''
+                INSERT INTO category_files(id, category_id, file_unique_id, caption, added_at)
+                SELECT id, category_id, file_id, caption, upload_date
+                FROM files ORDER BY id
+                ON CONFLICT DO NOTHING
+            ''')
+            await conn.execute(
+                "SELECT setval(pg_get_serial_sequence('category_files', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+                "FROM category_files"
+            )
+            
+            # جدول قدیمی برای بازگشت احتمالی نگه داشته می‌شود
+            await conn.execute("DROP TRIGGER IF EXISTS files_counters_insert ON files")
+            await conn.execute("DROP TRIGGER IF EXISTS files_counters_delete ON files")
+            await conn.execute("DROP FUNCTION IF EXISTS files_counters_insert()")
+            await conn.execute("DROP FUNCTION IF EXISTS files_counters_delete()")
+            await conn.execute("ALTER TABLE files RENAME TO files_legacy")
+            await conn.execute(RECOUNT_CATEGORIES_SQL)
+            logger.info("Legacy files table migrated to media/category_files")
 
     # --- مدیریت دسته‌ها ---
     async def add_category(self, name: str, created_by: int) -> str:
         """ایجاد دسته جدید"""
         category_id = str(uuid.uuid4())[:8]
-        async with self.pool.acquire() as conn:
+        async with self.acquire('db.add_category') as conn:
             await conn.execute(
                 "INSERT INTO categories(id, name, created_by) VALUES($1, $2, $3)",
                 category_id, name, created_by
             )
+        self.invalidate_category(category_id)
         return category_id
     
-    async def get_categories(self) -> dict:
-        """دریافت تمام دسته‌ها"""
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT id, name FROM categories")
-            return {row['id']: row['name'] for row in rows}
-    
-    async def get_category(self, category_id: str) -> dict:
-        """دریافت اطلاعات یک دسته"""
-        async with self.pool.acquire() as conn:
-            category = await conn.fetchrow(
-                "SELECT name, created_by FROM categories WHERE id = $1", category_id
+    async def get_categories_page(self, limit: int, after_id: str = None,
+                                  before_id: str = None, prefix: str = None) -> tuple:
+        """دریافت یک صفحه از دسته‌ها با keyset روی (created_at, id)؛ خروجی: (دسته‌ها، صفحه دیگری در همان جهت هست)"""
+        conditions, args = [], []
+        if prefix:
+            escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            args.append(escaped)
+            conditions.append(f"lower(name) LIKE ${len(args)} || '%'")
+        if after_id:
+            args.append(after_id)
+            conditions.append(f"(created_at, id) > (SELECT created_at, id FROM categories WHERE id = ${len(args)})")
+        if before_id:
+            args.append(before_id)
+            conditions.append(f"(created_at, id) < (SELECT created_at, id FROM categories WHERE id = ${len(args)})")
+        args.append(limit + 1)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'DESC' if before_id else 'ASC'
+        async with self.acquire('db.get_categories_page') as conn:
+            rows = await conn.fetch(
+                f"SELECT id, name, file_count, total_bytes FROM categories {where} "
+                f"ORDER BY created_at {order}, id {order} LIMIT ${len(args)}",
+                *args
             )
-            if not category:
+        
+        categories = [dict(row) for row in rows[:limit]]
+        if before_id:
+            categories.reverse()
+        return categories, len(rows) > limit
+    
+    async def get_category_summary(self, category_id: str) -> dict:
+        """دریافت نام و تعداد فایل‌های دسته بدون خواندن فایل‌ها"""
+        key = ('summary', category_id)
+        summary = self.cache.get(key)
+        if summary is None:
+            async with self.acquire('db.get_category_summary') as conn:
+                row = await conn.fetchrow(CATEGORY_SUMMARY_SQL, category_id)
+            if not row:
                 return None
-                
-            files = await conn.fetch(
-                "SELECT file_id, file_type, caption FROM files WHERE category_id = $1", category_id
-            )
-            return {
-                'name': category['name'],
-                'files': [dict(file) for file in files]
-            }
+            summary = dict(row)
+            self.cache.set(key, summary)
+        return summary
+    
+    def invalidate(self, *keys: tuple):
+        """حذف فوری کلیدها از کش این پروسه (پروسه‌های دیگر از تریگرها مطلع می‌شوند)"""
+        for key in keys:
+            self._drop_cached(key)
+    
+    def invalidate_category(self, category_id: str):
+        """حذف اطلاعات کش‌شده یک دسته"""
+        self.invalidate(('summary', category_id))
+    
+    async def delete_category(self, category_id: str) -> bool:
+        """حذف دسته و فایل‌هایی که در دسته دیگری استفاده نشده‌اند"""
+        async with self.acquire('db.delete_category') as conn:
+            async with conn.transaction():
+                unique_ids = [
+                    row['file_unique_id'] for row in await conn.fetch(
+                        "SELECT file_unique_id FROM category_files WHERE category_id = $1", category_id
+                    )
+                ]
+                result = await conn.execute(
+                    "DELETE FROM categories WHERE id = $1", category_id
+                )
+                await conn.execute(
+                    "DELETE FROM media m WHERE m.file_unique_id = ANY($1::text[]) "
+                    "AND NOT EXISTS (SELECT 1 FROM category_files cf WHERE cf.file_unique_id = m.file_unique_id)",
+                    unique_ids
+                )
+        self.invalidate_category(category_id)
+        return result.split()[-1] == '1'
 
     # --- مدیریت فایل‌ها ---
-    async def add_file(self, category_id: str, file_info: dict) -> bool:
-        """افزودن فایل به دسته"""
-        async with self.pool.acquire() as conn:
-            try:
+    async def add_files(self, category_id: str, files: list) -> int:
+        """افزودن گروهی فایل‌ها با COPY در یک تراکنش (فایل‌های تکراری دسته نادیده گرفته می‌شوند)"""
+        records = [
+            (
+                seq,
+                f.get('file_unique_id') or f['file_id'],
+                f['file_id'],
+                f['file_name'],
+                f['file_size'] or 0,
+                f['file_type'],
+                f.get('caption', '')
+            )
+            for seq, f in enumerate(files)
+        ]
+        async with self.acquire('db.add_files') as conn:
+            async with conn.transaction():
                 await conn.execute(
-                    "INSERT INTO files(category_id, file_id, file_name, file_size, file_type, caption) "
-                    "VALUES($1, $2, $3, $4, $5, $6)",
-                    category_id,
-                    file_info['file_id'],
-                    file_info['file_name'],
-                    file_info['file_size'],
-                    file_info['file_type'],
-                    file_info.get('caption', '')
+                    "CREATE TEMP TABLE files_staging ("
+                    "seq INT, file_unique_id TEXT, file_id TEXT, file_name TEXT, "
+                    "file_size BIGINT, file_type TEXT, caption TEXT"
+                    ") ON COMMIT DROP"
                 )
-                return True
-            except asyncpg.UniqueViolationError:
-                return False
+                await conn.copy_records_to_table('files_staging', records=records)
+                inserted = await self.link_files(conn, category_id, "SELECT * FROM files_staging")
+        self.invalidate_category(category_id)
+        return inserted
     
-    async def add_files(self, category_id: str, files: list) -> int:
-        async with self.pool.acquire() as conn:
-            inserted_count = 0
-            for f in files:
-                try:
-                    await conn.execute(
-                        "INSERT INTO files(category_id, file_id, file_name, file_size, file_type, caption) "
-                        "VALUES($1, $2, $3, $4, $5, $6)",
-                        category_id,
-                        f['file_id'],
-                        f['file_name'],
-                        f['file_size'],
-                        f['file_type'],
-                        f.get('caption', '')
-                    )
-                    inserted_count += 1
-                except asyncpg.UniqueViolationError:
-                    continue
-            return inserted_count
+    async def link_files(self, conn, category_id: str, source: str, *args) -> int:
+        """ذخیره media جدید و اتصال فایل‌های یک کوئری به دسته؛ خروجی: تعداد فایل‌های تازه اضافه‌شده به دسته
+        
+        ستون‌های source: seq, file_unique_id, file_id, file_name, file_size, file_type, caption
+        """
+        await conn.execute(
+            "INSERT INTO media(file_unique_id, file_id, file_name, file_size, file_type) "
+            f"SELECT file_unique_id, file_id, file_name, file_size, file_type FROM ({source}) s "
+            "ORDER BY seq ON CONFLICT (file_unique_id) DO NOTHING",
+            *args
+        )
+        result = await conn.execute(
+            "INSERT INTO category_files(category_id, file_unique_id, caption) "
+            f"SELECT ${len(args) + 1}, file_unique_id, caption FROM ({source}) s "
+            "ORDER BY seq ON CONFLICT (category_id, file_unique_id) DO NOTHING",
+            *args, category_id
+        )
+        return int(result.split()[-1])
+
+    async def get_files_page(self, category_id: str, after_id: int, limit: int) -> list:
+        """دریافت یک صفحه از فایل‌های دسته بعد از شناسه مشخص (keyset)"""
+        async with self.acquire('db.get_files_page') as conn:
+            rows = await conn.fetch(FILES_PAGE_SQL, category_id, after_id, limit)
+        return [dict(row) for row in rows]
+
+    # --- پیشرفت ارسال ---
+    async def get_delivery_cursor(self, chat_id: int, category_id: str) -> int:
+        """آخرین فایل ارسال‌شده در یک ارسال نیمه‌تمام (یا 0)"""
+        async with self.acquire('db.get_delivery_cursor') as conn:
+            last_file_id = await conn.fetchval(
+                "SELECT last_file_id FROM delivery_progress "
+                "WHERE chat_id = $1 AND category_id = $2 "
+                "AND updated_at > NOW() - make_interval(secs => $3)",
+                chat_id, category_id, DELIVERY_RESUME_WINDOW
+            )
+        return last_file_id or 0
+    
+    async def save_delivery_cursor(self, chat_id: int, category_id: str, last_file_id: int):
+        """ذخیره پیشرفت ارسال"""
+        async with self.acquire('db.save_delivery_cursor') as conn:
+            await conn.execute(
+                "INSERT INTO delivery_progress(chat_id, category_id, last_file_id) VALUES($1, $2, $3) "
+                "ON CONFLICT (chat_id, category_id) "
+                "DO UPDATE SET last_file_id = EXCLUDED.last_file_id, updated_at = NOW()",
+                chat_id, category_id, last_file_id
+            )
+    
+    async def clear_delivery_cursor(self, chat_id: int, category_id: str):
+        """حذف پیشرفت ارسال پس از تکمیل"""
+        async with self.acquire('db.clear_delivery_cursor') as conn:
+            await conn.execute(
+                "DELETE FROM delivery_progress WHERE chat_id = $1 AND category_id = $2",
+                chat_id, category_id
+            )
+
+    # --- صف ارسال ---
+    async def enqueue_delivery(self, chat_id: int, category_id: str) -> bool:
+        """ثبت کار ارسال دسته؛ False اگر همین ارسال از قبل در صف باشد"""
+        async with self.acquire('db.enqueue_delivery') as conn:
+            result = await conn.execute(
+                "INSERT INTO delivery_jobs(chat_id, category_id) VALUES($1, $2) "
+                "ON CONFLICT (chat_id, category_id) DO NOTHING",
+                chat_id, category_id
+            )
+        return result.split()[-1] == '1'
+    
+    async def claim_delivery_job(self) -> dict:
+        """برداشتن یک کار آماده از صف (یا None)؛ کار تا پایان مهلت lease به این worker تعلق دارد"""
+        async with self.acquire('db.claim_delivery_job') as conn:
+            row = await conn.fetchrow(CLAIM_DELIVERY_JOB_SQL, DELIVERY_JOB_LEASE, 1)
+        return dict(row) if row else None
+    
+    async def extend_delivery_job(self, job_id: int):
+        """تمدید lease کار در حال اجرا"""
+        async with self.acquire('db.extend_delivery_job') as conn:
+            await conn.execute(
+                "UPDATE delivery_jobs SET locked_until = NOW() + make_interval(secs => $2) WHERE id = $1",
+                job_id, DELIVERY_JOB_LEASE
+            )
+    
+    async def retry_delivery_job(self, job_id: int, delay: float, count_attempt: bool = True):
+        """بازگرداندن کار به صف برای اجرای دوباره پس از delay ثانیه"""
+        async with self.acquire('db.retry_delivery_job') as conn:
+            await conn.execute(
+                "UPDATE delivery_jobs SET locked_until = NULL, "
+                "available_at = NOW() + make_interval(secs => $2), "
+                "attempts = attempts - CASE WHEN $3 THEN 0 ELSE 1 END "
+                "WHERE id = $1",
+                job_id, delay, count_attempt
+            )
+    
+    async def finish_delivery_job(self, job_id: int):
+        """حذف کار پایان‌یافته از صف"""
+        async with self.acquire('db.finish_delivery_job') as conn:
+            await conn.execute("DELETE FROM delivery_jobs WHERE id = $1", job_id)
 
     # --- مدیریت کانال‌ها ---
     async def add_channel(self, channel_id: str, name: str, link: str) -> bool:
         """افزودن کانال اجباری"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire('db.add_channel') as conn:
             try:
                 await conn.execute(
                     "INSERT INTO channels(channel_id, channel_name, invite_link) VALUES($1, $2, $3)",
                     channel_id, name, link
                 )
-                return True
             except asyncpg.UniqueViolationError:
                 return False
+        self.invalidate(('channels',))
+        return True
     
     async def get_channels(self) -> list:
-        """دریافت لیست کانال‌ها"""
-        async with self.pool.acquire() as conn:
-            return await conn.fetch("SELECT channel_id, channel_name, invite_link FROM channels")
+        """دریافت لیست کانال‌ها (از کش در صورت وجود)"""
+        channels = self.cache.get(('channels',))
+        if channels is None:
+            async with self.acquire('db.get_channels') as conn:
+                channels = await conn.fetch(CHANNELS_SQL)
+            self.cache.set(('channels',), channels)
+        return channels
     
     async def delete_channel(self, channel_id: str) -> bool:
         """حذف کانال"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(
-                "DELETE FROM channels WHERE channel_id = $1", channel_id
+        async with self.acquire('db.delete_channel') as conn:
+            async with conn.transaction():
+                result = await conn.execute(
+                    "DELETE FROM channels WHERE channel_id = $1", channel_id
+                )
+                await conn.execute("DELETE FROM channel_members WHERE channel_id = $1", channel_id)
+        self.invalidate(('channels',))
+        return result.split()[-1] == '1'
+    
+    # --- عضویت در کانال‌ها ---
+    async def get_channel_memberships(self, user_id: int, channel_ids: list) -> dict:
+        """وضعیت‌های ثبت‌شده عضویت کاربر: {channel_id: is_member} فقط برای کانال‌های شناخته‌شده"""
+        async with self.acquire('db.get_channel_memberships') as conn:
+            rows = await conn.fetch(
+                "SELECT channel_id, is_member FROM channel_members "
+                "WHERE user_id = $1 AND channel_id = ANY($2::text[])",
+                user_id, channel_ids
             )
-            return result.split()[-1] == '1'
+        return {row['channel_id']: row['is_member'] for row in rows}
+    
+    async def set_channel_memberships(self, user_id: int, memberships: dict):
+        """ثبت وضعیت عضویت کاربر در یک یا چند کانال"""
+        async with self.acquire('db.set_channel_memberships') as conn:
+            await conn.execute(
+                "INSERT INTO channel_members(channel_id, user_id, is_member) "
+                "SELECT channel_id, $1, is_member FROM unnest($2::text[], $3::boolean[]) AS m(channel_id, is_member) "
+                "ON CONFLICT (user_id, channel_id) "
+                "DO UPDATE SET is_member = EXCLUDED.is_member, updated_at = NOW()",
+                user_id, list(memberships), list(memberships.values())
+            )
+
+class SessionStore(ABC):
+    """رابط ذخیره‌ساز نشست‌های آپلود و افزودن کانال ادمین‌ها"""
+    
+    def __init__(self, db: Database):
+        self.db = db
+    
+    async def init(self):
+        """آماده‌سازی ذخیره‌ساز"""
+    
+    @abstractmethod
+    async def start_upload(self, user_id: int, category_id: str):
+        """شروع (یا شروع مجدد) نشست آپلود"""
+    
+    @abstractmethod
+    async def has_upload(self, user_id: int) -> bool:
+        """بررسی فعال بودن نشست آپلود"""
+    
+    @abstractmethod
+    async def add_upload_files(self, user_id: int, files: list) -> dict:
+        """افزودن فایل‌ها به نشست؛ خروجی: {'file_count', 'total_bytes'} یا None در صورت نبود نشست"""
+    
+    @abstractmethod
+    async def finish_upload(self, user_id: int) -> dict:
+        """انتقال فایل‌های نشست به دسته و بستن نشست (None در صورت نبود نشست)"""
+    
+    @abstractmethod
+    async def cancel_upload(self, user_id: int):
+        """لغو نشست آپلود"""
+    
+    @abstractmethod
+    async def get_channel_session(self, user_id: int) -> dict:
+        """اطلاعات نیمه‌کاره کانال یا None"""
+    
+    @abstractmethod
+    async def set_channel_session(self, user_id: int, data: dict):
+        """ذخیره اطلاعات نیمه‌کاره کانال"""
+    
+    @abstractmethod
+    async def clear_channel_session(self, user_id: int):
+        """حذف اطلاعات نیمه‌کاره کانال"""
+    
+    @abstractmethod
+    async def expire_sessions(self) -> int:
+        """حذف نشست‌های رهاشده قدیمی‌تر از SESSION_TTL"""
+
+class MemorySessionStore(SessionStore):
+    """ذخیره نشست‌ها در حافظه (فقط برای اجرا با یک پروسه)"""
+    
+    def __init__(self, db: Database):
+        super().__init__(db)
+        self.uploads = {}  # {user_id: {'category_id': str, 'files': list, 'updated_at': float}}
+        self.channels = {}  # {user_id: {'data': dict, 'updated_at': float}}
+    
+    async def start_upload(self, user_id: int, category_id: str):
+        self.uploads[user_id] = {'category_id': category_id, 'files': [], 'updated_at': time.time()}
+    
+    async def has_upload(self, user_id: int) -> bool:
+        return user_id in self.uploads
+    
+    async def add_upload_files(self, user_id: int, files: list) -> dict:
+        upload = self.uploads.get(user_id)
+        if upload is None:
+            return None
+        upload['files'].extend(files)
+        upload['updated_at'] = time.time()
+        return {
+            'file_count': len(upload['files']),
+            'total_bytes': sum(f['file_size'] or 0 for f in upload['files'])
+        }
+    
+    async def finish_upload(self, user_id: int) -> dict:
+        upload = self.uploads.pop(user_id, None)
+        if upload is None:
+            return None
+        inserted = 0
+        if upload['files']:
+            inserted = await self.db.add_files(upload['category_id'], upload['files'])
+        return {
+            'category_id': upload['category_id'],
+            'staged': len(upload['files']),
+            'inserted': inserted
+        }
+    
+    async def cancel_upload(self, user_id: int):
+        self.uploads.pop(user_id, None)
+    
+    async def get_channel_session(self, user_id: int) -> dict:
+        session = self.channels.get(user_id)
+        return session['data'] if session else None
+    
+    async def set_channel_session(self, user_id: int, data: dict):
+        self.channels[user_id] = {'data': data, 'updated_at': time.time()}
+    
+    async def clear_channel_session(self, user_id: int):
+        self.channels.pop(user_id, None)
+    
+    async def expire_sessions(self) -> int:
+        deadline = time.time() - SESSION_TTL
+        expired = 0
+        for sessions in (self.uploads, self.channels):
+            for user_id in [uid for uid, session in sessions.items() if session['updated_at'] < deadline]:
+                del sessions[user_id]
+                expired += 1
+        return expired
+
+class PostgresSessionStore(SessionStore):
+    """ذخیره نشست‌ها در PostgreSQL تا پس از ری‌استارت حفظ شوند و بین چند نمونه ربات مشترک باشند"""
+    
+    async def init(self):
+        async with self.db.acquire('sessions.init') as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    user_id BIGINT PRIMARY KEY,
+                    category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+                    file_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            await conn.execute(
+                "ALTER TABLE upload_sessions ADD COLUMN IF NOT EXISTS total_bytes BIGINT NOT NULL DEFAULT 0"
+            )
+            
+            # فایل‌های هر نشست همان لحظه دریافت در این جدول ذخیره می‌شوند
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_staging (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL REFERENCES upload_sessions(user_id) ON DELETE CASCADE,
+                    file_unique_id TEXT,
+                    file_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    file_size BIGINT NOT NULL,
+                    file_type TEXT NOT NULL,
+                    caption TEXT
+                )
+            ''')
+            
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS channel_sessions (
+                    user_id BIGINT PRIMARY KEY,
+                    data JSONB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            
+            await conn.execute("ALTER TABLE upload_staging ADD COLUMN IF NOT EXISTS file_unique_id TEXT")
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_staging_user ON upload_staging(user_id, id)')
+    
+    async def start_upload(self, user_id: int, category_id: str):
+        async with self.db.acquire('sessions.start_upload') as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM upload_sessions WHERE user_id = $1", user_id)
+                await conn.execute(
+                    "INSERT INTO upload_sessions(user_id, category_id) VALUES($1, $2)",
+                    user_id, category_id
+                )
+    
+    async def has_upload(self, user_id: int) -> bool:
+        async with self.db.acquire('sessions.has_upload') as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS(SELECT 1 FROM upload_sessions WHERE user_id = $1)", user_id
+            )
+    
+    async def add_upload_files(self, user_id: int, files: list) -> dict:
+        sizes = [f['file_size'] or 0 for f in files]
+        async with self.db.acquire('sessions.add_upload_files') as conn:
+            row = await conn.fetchrow(
+                '''
+                WITH upload AS (
+                    UPDATE upload_sessions
+                    SET file_count = file_count + $8,
+                        total_bytes = total_bytes + $9,
+                        updated_at = NOW()
+                    WHERE user_id = $1
+                    RETURNING user_id, file_count, total_bytes
+                ), staged AS (
+                    INSERT INTO upload_staging(user_id, file_unique_id, file_id, file_name, file_size, file_type, caption)
+                    SELECT upload.user_id, f.file_unique_id, f.file_id, f.file_name, f.file_size, f.file_type, f.caption
+                    FROM upload, unnest($2::text[], $3::text[], $4::text[], $5::bigint[], $6::text[], $7::text[])
+                        WITH ORDINALITY AS f(file_unique_id, file_id, file_name, file_size, file_type, caption, seq)
+                    ORDER BY f.seq
+                )
+                SELECT file_count, total_bytes FROM upload
+                ''',
+                user_id,
+                [f.get('file_unique_id') or f['file_id'] for f in files],
+                [f['file_id'] for f in files],
+                [f['file_name'] for f in files],
+                sizes,
+                [f['file_type'] for f in files],
+                [f.get('caption', '') for f in files],
+                len(files),
+                sum(sizes)
+            )
+        return dict(row) if row else None
+    
+    async def finish_upload(self, user_id: int) -> dict:
+        async with self.db.acquire('sessions.finish_upload') as conn:
+            async with conn.transaction():
+                session = await conn.fetchrow(
+                    "SELECT category_id, file_count FROM upload_sessions WHERE user_id = $1 FOR UPDATE",
+                    user_id
+                )
+                if not session:
+                    return None
+                
+                # ردیف‌های مانده از پیش از افزودن file_unique_id با file_id کلید می‌شوند
+                inserted = await self.db.link_files(
+                    conn,
+                    session['category_id'],
+                    "SELECT id AS seq, COALESCE(file_unique_id, file_id) AS file_unique_id, "
+                    "file_id, file_name, file_size, file_type, caption "
+                    "FROM upload_staging WHERE user_id = $1",
+                    user_id
+                )
+                await conn.execute("DELETE FROM upload_sessions WHERE user_id = $1", user_id)
+        
+        self.db.invalidate_category(session['category_id'])
+        return {
+            'category_id': session['category_id'],
+            'staged': session['file_count'],
+            'inserted': inserted
+        }
+    
+    async def cancel_upload(self, user_id: int):
+        async with self.db.acquire('sessions.cancel_upload') as conn:
+            await conn.execute("DELETE FROM upload_sessions WHERE user_id = $1", user_id)
+    
+    async def get_channel_session(self, user_id: int) -> dict:
+        async with self.db.acquire('sessions.get_channel_session') as conn:
+            data = await conn.fetchval(
+                "SELECT data FROM channel_sessions WHERE user_id = $1", user_id
+            )
+        return json.loads(data) if data is not None else None
+    
+    async def set_channel_session(self, user_id: int, data: dict):
+        async with self.db.acquire('sessions.set_channel_session') as conn:
+            await conn.execute(
+                "INSERT INTO channel_sessions(user_id, data) VALUES($1, $2) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()",
+                user_id, json.dumps(data)
+            )
+    
+    async def clear_channel_session(self, user_id: int):
+        async with self.db.acquire('sessions.clear_channel_session') as conn:
+            await conn.execute("DELETE FROM channel_sessions WHERE user_id = $1", user_id)
+    
+    async def expire_sessions(self) -> int:
+        expired = 0
+        async with self.db.acquire('sessions.expire_sessions') as conn:
+            for table in ('upload_sessions', 'channel_sessions'):
+                result = await conn.execute(
+                    f"DELETE FROM {table} WHERE updated_at < NOW() - make_interval(secs => $1)",
+                    SESSION_TTL
+                )
+                expired += int(result.split()[-1])
+        return expired
+
+SESSION_STORES = {
+    'postgres': PostgresSessionStore,
+    'memory': MemorySessionStore
+}
+
+class UploadProgress:
+    """یک پیام وضعیت برای هر نشست آپلود که حداکثر هر UPLOAD_ACK_INTERVAL ثانیه ویرایش می‌شود"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.states = {}  # {user_id: {'message', 'text', 'shown', 'last_edit', 'task', 'lock'}}
+    
+    async def report(self, user_id: int, reply_to: Message, file_count: int, total_bytes: int):
+        """ثبت وضعیت جدید؛ پیام فقط در صورت گذشتن فاصله لازم ویرایش می‌شود"""
+        state = self.states.setdefault(user_id, {
+            'message': None, 'text': None, 'shown': None,
+            'last_edit': 0.0, 'task': None, 'lock': asyncio.Lock()
+        })
+        state['text'] = (
+            f"📥 در حال دریافت فایل‌ها...\n"
+            f"📦 تعداد: {file_count}\n"
+            f"💾 حجم کل: {format_size(total_bytes)}\n\n"
+            f"برای پایان: /finish_upload"
+        )
+        
+        async with state['lock']:
+            if state['message'] is None:
+                state['message'] = await bot_manager.delivery.send(
+                    reply_to.chat_id, reply_to.reply_text, state['text'])
+                state['shown'] = state['text']
+                state['last_edit'] = time.monotonic()
+                return
+        
+        delay = state['last_edit'] + self.interval - time.monotonic()
+        if delay <= 0:
+            await self._flush(state)
+        elif state['task'] is None:
+            state['task'] = asyncio.create_task(self._flush_later(state, delay))
+    
+    async def _flush_later(self, state: dict, delay: float):
+        await asyncio.sleep(delay)
+        state['task'] = None
+        await self._flush(state)
+    
+    async def _flush(self, state: dict):
+        async with state['lock']:
+            if state['text'] == state['shown']:
+                return
+            text = state['text']
+            state['last_edit'] = time.monotonic()
+            try:
+                await bot_manager.delivery.send(
+                    state['message'].chat_id, state['message'].edit_text, text)
+                state['shown'] = text
+            except Exception as e:
+                logger.warning(f"خطا در به‌روزرسانی پیام وضعیت آپلود: {e}")
+    
+    def clear(self, user_id: int):
+        """پایان نمایش وضعیت یک نشست"""
+        state = self.states.pop(user_id, None)
+        if state and state['task']:
+            state['task'].cancel()
+
+class DeliveryQueue:
+    """workerهای تخلیه صف پایدار ارسال؛ هر پروسه می‌تواند تعداد دلخواهی worker داشته باشد"""
+    
+    def __init__(self, db: Database, workers: int):
+        self.db = db
+        self.workers = workers
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.draining = False
+    
+    async def enqueue(self, chat_id: int, category_id: str) -> bool:
+        """ثبت ارسال در صف و بیدار کردن workerهای همین پروسه"""
+        queued = await self.db.enqueue_delivery(chat_id, category_id)
+        if queued:
+            self.wakeup.set()
+        return queued
+    
+    def start(self, bot, deliver):
+        """اجرای workerها؛ deliver(bot, job) ارسال یک کار را انجام می‌دهد"""
+        for worker_id in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._run(bot, deliver, worker_id)))
+        logger.info(f"🚚 {self.workers} delivery worker(s) started")
+    
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """توقف workerها: کار جدیدی برداشته نمی‌شود و کارهای در جریان تا timeout فرصت تکمیل دارند"""
+        self.draining = True
+        self.wakeup.set()
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            if pending:
+                logger.warning(f"⏳ {len(pending)} delivery worker(s) did not finish in time, checkpointing")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    async def _run(self, bot, deliver, worker_id: int):
+        while not self.draining:
+            try:
+                job = await self.db.claim_delivery_job()
+            except Exception as e:
+                logger.error(f"خطا در دریافت کار از صف ارسال (worker {worker_id}): {e}")
+                job = None
+            
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), DELIVERY_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                if not self.draining:
+                    self.wakeup.clear()
+                continue
+            
+            await self._process(bot, deliver, job)
+    
+    async def _heartbeat(self, job_id: int):
+        """تمدید دوره‌ای lease تا کار طولانی توسط worker دیگری برداشته نشود"""
+        while True:
+            await asyncio.sleep(DELIVERY_JOB_LEASE / 3)
+            try:
+                await self.db.extend_delivery_job(job_id)
+            except Exception as e:
+                logger.warning(f"خطا در تمدید lease کار {job_id}: {e}")
+    
+    async def _process(self, bot, deliver, job: dict):
+        heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+        try:
+            try:
+                await deliver(bot, job)
+            finally:
+                heartbeat.cancel()
+            await self.db.finish_delivery_job(job['id'])
+            metrics.inc('bot_delivery_jobs_total', result='done')
+        except asyncio.CancelledError:
+            # پیشرفت تا آخرین دسته ذخیره شده؛ کار بدون انتظار برای پایان lease به صف برمی‌گردد
+            await asyncio.shield(self.db.retry_delivery_job(job['id'], 0, count_attempt=False))
+            raise
+        except RetryAfter as e:
+            # محدودیت تلگرام جزو تلاش‌های ناموفق حساب نمی‌شود
+            logger.warning(f"ارسال دسته {job['category_id']} به {job['chat_id']} {e.retry_after} ثانیه عقب افتاد")
+            await self.db.retry_delivery_job(job['id'], e.retry_after, count_attempt=False)
+            metrics.inc('bot_delivery_jobs_total', result='retry')
+        except Exception as e:
+            logger.error(f"خطا در ارسال دسته {job['category_id']} به {job['chat_id']}: {e}")
+            if job['attempts'] < DELIVERY_JOB_MAX_ATTEMPTS:
+                await self.db.retry_delivery_job(job['id'], 30 * job['attempts'])
+                metrics.inc('bot_delivery_jobs_total', result='retry')
+                return
+            await self.db.finish_delivery_job(job['id'])
+            metrics.inc('bot_delivery_jobs_total', result='failed')
+            try:
+                await bot.send_message(job['chat_id'], "❌ خطایی در ارسال فایل‌ها رخ داد")
+            except Exception:
+                pass
+
+class HttpClient:
+    """یک ClientSession مشترک با اتصال‌های قابل استفاده مجدد برای همه درخواست‌های خروجی"""
+    
+    def __init__(self):
+        self.session = None
+    
+    def get(self) -> aiohttp.ClientSession:
+        """session مشترک (در اولین استفاده ساخته می‌شود)"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_CLIENT_POOL_SIZE, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=HTTP_CLIENT_TIMEOUT)
+            )
+        return self.session
+    
+    async def close(self):
+        """بستن session و اتصال‌های باز"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+class HotCategories:
+    """شمارش ارسال دسته‌ها در پنجره زمانی و نگهداری برنامه ارسال آماده برای K دسته پرطرفدار"""
+    
+    BUCKET_SECONDS = 10
+    
+    def __init__(self, db: Database):
+        self.db = db
+        self.opens = {}  # {category_id: deque([bucket, count])}
+        self.plans = {}  # {category_id: DeliveryPlan}
+        self.building = {}  # {category_id: Task}
+        self.refreshing = set()  # تسک‌های ساخت دوباره پس از باطل شدن
+        self.versions = {}  # با هر باطل شدن افزایش می‌یابد تا برنامه قدیمی ذخیره نشود
+        self.hot = frozenset()
+        self.hot_updated_at = 0.0
+        db.invalidation_callbacks.append(self._on_invalidate)
+    
+    def record(self, category_id: str):
+        """ثبت یک بار ارسال دسته (در پروسه‌ای که کار صف را برداشته است)"""
+        bucket = int(time.monotonic() // self.BUCKET_SECONDS)
+        counts = self.opens.setdefault(category_id, deque())
+        if counts and counts[-1][0] == bucket:
+            counts[-1][1] += 1
+        else:
+            counts.append([bucket, 1])
+    
+    def _refresh_hot(self):
+        """محاسبه دوباره K دسته پرطرفدار (حداکثر یک بار در ثانیه)"""
+        now = time.monotonic()
+        if now - self.hot_updated_at < 1:
+            return
+        self.hot_updated_at = now
+        oldest = int(now // self.BUCKET_SECONDS) - HOT_CATEGORY_WINDOW // self.BUCKET_SECONDS
+        totals = {}
+        for category_id in list(self.opens):
+            counts = self.opens[category_id]
+            while counts and counts[0][0] <= oldest:
+                counts.popleft()
+            if not counts:
+                del self.opens[category_id]
+                continue
+            total = sum(count for _, count in counts)
+            if total >= HOT_CATEGORY_MIN_OPENS / SHARED_PROCESSES:
+                totals[category_id] = total
+        
+        self.hot = frozenset(heapq.nlargest(HOT_CATEGORY_TOP_K, totals, key=totals.get))
+        for category_id in [cid for cid in self.plans if cid not in self.hot]:
+            del self.plans[category_id]
+    
+    async def get_plan(self, category_id: str) -> DeliveryPlan:
+        """برنامه ارسال آماده دسته یا None اگر دسته پرطرفدار نباشد"""
+        self._refresh_hot()
+        if category_id not in self.hot:
+            return None
+        plan = self.plans.get(category_id)
+        if plan is not None:
+            return plan
+        
+        # درخواست‌های همزمان منتظر همان یک بار ساخت برنامه می‌مانند
+        task = self.building.get(category_id)
+        if task is None:
+            task = self.building[category_id] = asyncio.create_task(self._build(category_id))
+            task.add_done_callback(lambda _: self.building.pop(category_id, None))
+        return await asyncio.shield(task)
+    
+    async def _build(self, category_id: str) -> DeliveryPlan:
+        version = self.versions.get(category_id, 0)
+        summary = await self.db.get_category_summary(category_id)
+        if not summary or not summary['file_count'] or summary['file_count'] > HOT_CATEGORY_MAX_FILES:
+            return None
+        
+        files, after_id = [], 0
+        while True:
+            page = await self.db.get_files_page(category_id, after_id, 1000)
+            files.extend(page)
+            if len(page) < 1000:
+                break
+            after_id = page[-1]['id']
+        
+        steps = compile_delivery_steps(files)
+        plan = DeliveryPlan(
+            name=summary['name'],
+            file_count=len(files),
+            steps=steps,
+            last_ids=tuple(step.last_id for step in steps)
+        )
+        if self.versions.get(category_id, 0) == version and category_id in self.hot:
+            self.plans[category_id] = plan
+            logger.info(f"🔥 Delivery plan cached for hot category {category_id} ({len(files)} files)")
+        return plan
+    
+    def _on_invalidate(self, key: tuple):
+        """حذف برنامه دسته تغییر‌یافته و ساخت دوباره آن در پس‌زمینه"""
+        if key is None:
+            category_ids = list(self.plans)
+        elif key[0] == 'summary':
+            category_ids = [key[1]]
+        else:
+            return
+        for category_id in category_ids:
+            self.versions[category_id] = self.versions.get(category_id, 0) + 1
+            if self.plans.pop(category_id, None) is not None:
+                task = asyncio.get_running_loop().create_task(self._refresh(category_id))
+                self.refreshing.add(task)
+                task.add_done_callback(self.refreshing.discard)
+    
+    async def _refresh(self, category_id: str):
+        try:
+            await self.get_plan(category_id)
+        except Exception as e:
+            logger.warning(f"خطا در ساخت دوباره برنامه ارسال دسته {category_id}: {e}")
 
 class BotManager:
     """مدیریت اصلی ربات"""
     
     def __init__(self):
         self.db = Database()
-        self.pending_uploads = {}  # {user_id: {'category_id': str, 'files': list}}
-        self.pending_channels = {}  # {user_id: {'channel_id': str, 'name': str, 'link': str}}
+        self.sessions = SESSION_STORES[SESSION_STORE](self.db)
+        self.upload_progress = UploadProgress(UPLOAD_ACK_INTERVAL)
+        # فایل‌های آلبوم‌های در حال دریافت: {(user_id, media_group_id): {'files', 'message', 'task'}}
+        self.pending_albums = {}
+        # ترتیب نوشتن فایل‌های هر کاربر؛ ذخیره هر آلبوم تا پایان این قفل را نگه می‌دارد
+        self.upload_locks = {}  # {user_id: Lock}
         self.bot_username = None
+        self.application = None
+        # فقط نتایج مثبت عضویت کش می‌شوند: {(user_id, channel_id): True}
+        self.membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+        self.membership_semaphore = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+        # سطل توکن هر کاربر؛ کاربران غیرفعال پس از ده دقیقه حذف می‌شوند
+        self.user_buckets = TTLCache(maxsize=100000, ttl=600)
+        # درخواست‌های در حال اجرای هر کاربر: {(user_id, category_id): Task}
+        self.user_requests = {}
+        # محدودیت تلگرام برای کل ربات است؛ هر پروسه سهم خود را از آن دارد
+        self.delivery = DeliveryScheduler(
+            DELIVERY_GLOBAL_RATE / SHARED_PROCESSES, DELIVERY_CHAT_RATE, DELIVERY_CHAT_BURST)
+        self.deliveries = DeliveryQueue(self.db, DELIVERY_WORKERS)
+        self.hot_categories = HotCategories(self.db)
+        self.http = HttpClient()
+        # زمان آخرین درخواست ورودی به سرور وب (به جز پینگ keep-alive)
+        self.last_activity = 0.0
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """ثبت gaugeهای وضعیت داخلی ربات"""
+        metrics.describe('bot_db_pool_in_use', "asyncpg connections currently checked out")
+        metrics.gauge('bot_db_pool_in_use', self.db.pool_in_use)
+        metrics.describe('bot_db_pool_size', "asyncpg pool size")
+        metrics.gauge('bot_db_pool_size', lambda: self.db.pool.get_size() if self.db.pool else 0)
+        metrics.describe('bot_delivery_throughput', "Messages sent per second over the last minute")
+        metrics.gauge('bot_delivery_throughput', self.delivery.throughput)
+        metrics.describe('bot_active_deliveries', "Category deliveries in progress")
+        metrics.gauge('bot_active_deliveries', lambda: self.delivery.active_deliveries)
+        metrics.describe('bot_membership_cache_hit_rate', "Membership cache hit rate")
+        metrics.gauge('bot_membership_cache_hit_rate', lambda: self.membership_cache.stats()['hit_rate'])
+        metrics.describe('bot_db_cache_hit_rate', "Database read cache hit rate")
+        metrics.gauge('bot_db_cache_hit_rate', lambda: self.db.cache.stats()['hit_rate'])
+        metrics.describe('bot_hot_category_plans', "Precompiled delivery plans held for hot categories")
+        metrics.gauge('bot_hot_category_plans', lambda: len(self.hot_categories.plans))
     
     async def init(self, bot_username: str):
         """راه‌اندازی اولیه"""
         self.bot_username = bot_username
         await self.db.connect()
+        await self.sessions.init()
+    
+    def allow_user(self, user_id: int) -> bool:
+        """بررسی محدودیت نرخ درخواست کاربر (ادمین‌ها محدود نمی‌شوند)"""
+        if self.is_admin(user_id):
+            return True
+        bucket = self.user_buckets.get(user_id) or TokenBucket(USER_RATE, USER_BURST)
+        # انقضا با هر درخواست تمدید می‌شود تا کاربر فعال سطل پر جدیدی نگیرد
+        self.user_buckets.set(user_id, bucket)
+        if bucket.try_acquire():
+            return True
+        metrics.inc('bot_user_throttled_total')
+        return False
+    
+    async def coalesce(self, user_id: int, category_id: str, factory):
+        """اجرای یک بار درخواست کاربر برای دسته؛ درخواست‌های تکراری منتظر همان اجرا می‌مانند"""
+        key = (user_id, category_id)
+        task = self.user_requests.get(key)
+        if task is not None:
+            metrics.inc('bot_coalesced_requests_total')
+            await asyncio.shield(task)
+            return
+        task = self.user_requests[key] = asyncio.create_task(factory())
+        task.add_done_callback(lambda _: self.user_requests.pop(key, None))
+        await asyncio.shield(task)
     
     def is_admin(self, user_id: int) -> bool:
         """بررسی ادمین بودن کاربر"""
@@ -230,12 +1928,20 @@ class BotManager:
 
         return {
             'file_id': file.file_id,
+            'file_unique_id': file.file_unique_id,
             'file_name': file_name,
             'file_size': file.file_size,
             'file_type': file_type,
             'caption': msg.caption or ''
         }
 
+def format_size(size: int) -> str:
+    """نمایش خوانای حجم فایل"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
 # ایجاد نمونه
 bot_manager = BotManager()
 
@@ -250,7 +1956,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # دسترسی از طریق لینک دسته
     if context.args and context.args[0].startswith('cat_'):
         category_id = context.args[0][4:]
-        await handle_category(update, context, category_id)
+        if not bot_manager.allow_user(user_id):
+            return
+        await bot_manager.coalesce(
+            user_id, category_id, lambda: handle_category(update, context, category_id))
         return
     
     if bot_manager.is_admin(user_id):
@@ -269,19 +1978,85 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("👋 سلام! برای دریافت فایل‌ها از لینک‌ها استفاده کنید.")
 
 async def is_user_member(context, channel_id, user_id):
-    """بررسی عضویت کاربر با تلاش مجدد"""
-    for _ in range(3):  # 3 بار تلاش
+    """بررسی عضویت کاربر با تلاش مجدد؛ ظرفیت همزمانی فقط هنگام فراخوانی API گرفته می‌شود"""
+    for attempt in range(3):  # 3 بار تلاش
         try:
-            member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                return True
+            async with Span('wait.membership_slot'):
+                await bot_manager.membership_semaphore.acquire()
+            try:
+                started_at = time.perf_counter()
+                member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+            finally:
+                metrics.observe('bot_membership_check_seconds', time.perf_counter() - started_at)
+                bot_manager.membership_semaphore.release()
+            # پاسخ موفق API قطعی است و نیازی به تلاش مجدد ندارد
+            return member.status in MEMBER_STATUSES
+        except (BadRequest, Forbidden) as e:
+            # کانال/کاربر نامعتبر یا ربات بدون دسترسی؛ تلاش مجدد نتیجه را تغییر نمی‌دهد
+            logger.warning(f"خطا در بررسی عضویت: {e}")
+            return False
         except Exception as e:
             logger.warning(f"خطا در بررسی عضویت: {e}")
         
-        await asyncio.sleep(2)  # تاخیر 2 ثانیه‌ای بین هر تلاش
+        if attempt < 2:
+            async with Span('sleep.membership_retry'):
+                await asyncio.sleep(2)  # تاخیر 2 ثانیه‌ای بین هر تلاش
     
     return False
 
+async def check_membership(context, channel_id, user_id) -> bool:
+    """بررسی عضویت با استفاده از کش"""
+    key = (user_id, channel_id)
+    if bot_manager.membership_cache.get(key):
+        metrics.inc('bot_membership_cache_hits_total')
+        return True
+    
+    metrics.inc('bot_membership_cache_misses_total')
+    is_member = await is_user_member(context, channel_id, user_id)
+    if is_member:
+        bot_manager.membership_cache.set(key, True)
+    return is_member
+
+async def get_non_joined_channels(context, channels, user_id, recheck: bool = False) -> list:
+    """بررسی همزمان عضویت کاربر در همه کانال‌ها؛ با recheck عدم عضویت ثبت‌شده دوباره از API پرسیده می‌شود"""
+    known = {}
+    if MEMBERSHIP_UPDATES:
+        # عضویت‌های ثبت‌شده از آپدیت‌های chat_member بدون فراخوانی API
+        known = await bot_manager.db.get_channel_memberships(
+            user_id, [channel['channel_id'] for channel in channels])
+        if recheck:
+            # ممکن است آپدیت عضویت مجدد از دست رفته یا هنوز نرسیده باشد
+            known = {channel_id: True for channel_id, is_member in known.items() if is_member}
+    
+    unknown = [channel for channel in channels if channel['channel_id'] not in known]
+    results = await asyncio.gather(*(
+        check_membership(context, channel['channel_id'], user_id)
+        for channel in unknown
+    ))
+    checked = {channel['channel_id']: is_member for channel, is_member in zip(unknown, results)}
+    
+    # فقط نتایج مثبت ذخیره می‌شوند؛ False ممکن است ناشی از خطای API باشد
+    joined = {channel_id: True for channel_id, is_member in checked.items() if is_member}
+    if MEMBERSHIP_UPDATES and joined:
+        await bot_manager.db.set_channel_memberships(user_id, joined)
+    
+    known.update(checked)
+    return [channel for channel in channels if not known[channel['channel_id']]]
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ثبت ورود و خروج کاربران کانال‌های اجباری از آپدیت‌های chat_member"""
+    member_update = update.chat_member
+    channel_id = str(member_update.chat.id)
+    channels = await bot_manager.db.get_channels()
+    if not any(channel['channel_id'] == channel_id for channel in channels):
+        return
+    
+    user_id = member_update.new_chat_member.user.id
+    is_member = member_update.new_chat_member.status in MEMBER_STATUSES
+    await bot_manager.db.set_channel_memberships(user_id, {channel_id: is_member})
+    if not is_member:
+        bot_manager.membership_cache.pop((user_id, channel_id))
+
 async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str):
     """مدیریت دسترسی به دسته"""
     # استخراج user_id و message بسته به نوع update
@@ -303,17 +2078,12 @@ async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE, ca
     # بررسی عضویت در کانال‌ها
     channels = await bot_manager.db.get_channels()
     if not channels:
-        await send_category_files(message, context, category_id)
+        await queue_category_delivery(message, category_id)
         return
     
-    non_joined = []
-    for channel in channels:
-        is_member = await is_user_member(context, channel['channel_id'], user_id)
-        if not is_member:
-            non_joined.append(channel)
-    
+    non_joined = await get_non_joined_channels(context, channels, user_id)
     if not non_joined:
-        await send_category_files(message, context, category_id)
+        await queue_category_delivery(message, category_id)
         return
     
     # ایجاد صفحه عضویت
@@ -340,7 +2110,7 @@ async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE, ca
 async def admin_category_menu(message: Message, category_id: str):
     """منوی مدیریت دسته برای ادمین"""
     try:
-        category = await bot_manager.db.get_category(category_id)
+        category = await bot_manager.db.get_category_summary(category_id)
         if not category:
             await message.reply_text("❌ دسته یافت نشد!")
             return
@@ -353,47 +2123,171 @@ async def admin_category_menu(message: Message, category_id: str):
         
         await message.reply_text(
             f"📂 دسته: {category['name']}\n"
-            f"📦 تعداد فایل‌ها: {len(category['files'])}\n\n"
+            f"📦 تعداد فایل‌ها: {category['file_count']}\n"
+            f"💾 حجم کل: {format_size(category['total_bytes'])}\n\n"
             "لطفا عملیات مورد نظر را انتخاب کنید:",
             reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logger.error(f"خطا در منوی ادمین: {e}")
         await message.reply_text("❌ خطایی در نمایش منو رخ داد")
 
-async def send_category_files(message: Message, context: ContextTypes.DEFAULT_TYPE, category_id: str):
-    """ارسال فایل‌های یک دسته"""
+def build_delivery_batches(files: list) -> list:
+    """گروه‌بندی فایل‌های متوالی و سازگار در آلبوم‌های حداکثر ۱۰تایی با حفظ ترتیب"""
+    batches = []
+    current, current_kind = [], None
+    for file in files:
+        kind = MEDIA_GROUP_TYPES.get(file['file_type'], (None,))[0] if DELIVERY_MEDIA_GROUPS else None
+        if current and (kind is None or kind != current_kind or len(current) == MEDIA_GROUP_MAX_SIZE):
+            batches.append(current)
+            current = []
+        current_kind = kind
+        current.append(file)
+        if kind is None:
+            batches.append(current)
+            current = []
+    if current:
+        batches.append(current)
+    return batches
+
+def compile_delivery_steps(files: list) -> tuple:
+    """تبدیل فایل‌ها به مراحل ارسال آماده با کپشن‌های کوتاه‌شده و آلبوم‌های ساخته‌شده"""
+    steps = []
+    for batch in build_delivery_batches(files):
+        sendable = [file for file in batch if file['file_type'] in SEND_METHODS]
+        singles = tuple(
+            (SEND_METHODS[file['file_type']], file['file_type'], file['file_id'], (file.get('caption') or '')[:1024])
+            for file in sendable
+        )
+        album = None
+        if len(sendable) > 1:
+            album = tuple(
+                MEDIA_GROUP_TYPES[file['file_type']][1](media=file_id, caption=caption)
+                for file, (_, _, file_id, caption) in zip(sendable, singles)
+            )
+        steps.append(DeliveryStep(batch[-1]['id'], album, singles, tuple(file['id'] for file in sendable)))
+    return tuple(steps)
+
+def trim_delivery_step(step: DeliveryStep, after_id: int) -> DeliveryStep:
+    """حذف فایل‌های ارسال‌شده (id <= after_id) از یک مرحله"""
+    keep = [i for i, file_id in enumerate(step.ids) if file_id > after_id]
+    album = tuple(step.album[i] for i in keep) if step.album and len(keep) > 1 else None
+    return DeliveryStep(
+        step.last_id, album, tuple(step.singles[i] for i in keep), tuple(step.ids[i] for i in keep))
+
+async def send_delivery_step(bot, chat_id: int, step: DeliveryStep) -> int:
+    """ارسال یک مرحله؛ آلبوم در صورت خطا به ارسال تکی فایل‌ها تبدیل می‌شود"""
+    delivery = bot_manager.delivery
+    if step.album:
+        try:
+            await delivery.send(chat_id, bot.send_media_group, chat_id=chat_id, media=step.album)
+            return len(step.album)
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            # فقط خطاهای Bot API؛ خطاهای برنامه نباید به شکل ارسال ناموفق پنهان شوند
+            logger.warning(f"ارسال آلبوم ناموفق بود، ارسال تکی فایل‌ها: {e}")
+    
+    sent = 0
+    for method, file_type, file_id, caption in step.singles:
+        try:
+            await delivery.send(
+                chat_id, getattr(bot, method), chat_id=chat_id, **{file_type: file_id}, caption=caption)
+            sent += 1
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            logger.error(f"ارسال فایل خطا: {e}")
+    return sent
+
+async def queue_category_delivery(message: Message, category_id: str):
+    """ثبت ارسال فایل‌های دسته در صف؛ ارسال توسط workerها انجام می‌شود و هندلر منتظر نمی‌ماند"""
     try:
-        chat_id = message.chat_id
-        
-        category = await bot_manager.db.get_category(category_id)
-        if not category or not category['files']:
+        category = await bot_manager.db.get_category_summary(category_id)
+        if not category or not category['file_count']:
             await message.reply_text("❌ فایلی برای نمایش وجود ندارد!")
             return
         
-        await message.reply_text(f"📤 ارسال فایل‌های '{category['name']}'...")
+        if not await bot_manager.deliveries.enqueue(message.chat_id, category_id):
+            await message.reply_text("⏳ ارسال فایل‌های این دسته در حال انجام است.")
+    except Exception as e:
+        logger.error(f"خطا در ثبت ارسال فایل‌ها: {e}")
+        await message.reply_text("❌ خطایی در ارسال فایل‌ها رخ داد")
+
+async def deliver_category(bot, job: dict):
+    """اجرای یک کار صف: ارسال صفحه‌به‌صفحه فایل‌های دسته با ادامه از آخرین فایل ارسال‌شده"""
+    delivery = bot_manager.delivery
+    db = bot_manager.db
+    chat_id, category_id = job['chat_id'], job['category_id']
+    if job['first_claim']:
+        bot_manager.hot_categories.record(category_id)
+    delivery.active_deliveries += 1
+    try:
+        # دسته‌های پرطرفدار بدون خواندن دیتابیس از برنامه آماده ارسال می‌شوند
+        plan = None if DELIVERY_PAGE_BUTTON else await bot_manager.hot_categories.get_plan(category_id)
+        if plan:
+            name, file_count = plan.name, plan.file_count
+        else:
+            category = await db.get_category_summary(category_id)
+            name, file_count = (category['name'], category['file_count']) if category else (None, 0)
+        if not file_count:
+            await delivery.send(chat_id, bot.send_message, chat_id, "❌ فایلی برای نمایش وجود ندارد!")
+            return
+        
+        after_id = await db.get_delivery_cursor(chat_id, category_id)
+        if after_id:
+            header = f"📤 ادامه ارسال فایل‌های '{name}'..."
+        else:
+            header = f"📤 ارسال فایل‌های '{name}'..."
+        await delivery.send(chat_id, bot.send_message, chat_id, header)
         
-        for file in category['files']:
-            try:
-                send_func = {
-                    'document': context.bot.send_document,
-                    'photo': context.bot.send_photo,
-                    'video': context.bot.send_video,
-                    'audio': context.bot.send_audio
-                }.get(file['file_type'])
+        started_at = time.monotonic()
+        sent = 0
+        if plan:
+            for step in plan.steps[bisect.bisect_right(plan.last_ids, after_id):]:
+                if step.ids and step.ids[0] <= after_id:
+                    # cursor مسیر صفحه‌ای ممکن است وسط یک مرحله برنامه باشد
+                    step = trim_delivery_step(step, after_id)
+                step_sent = await send_delivery_step(bot, chat_id, step)
+                metrics.inc('bot_files_delivered_total', step_sent)
+                sent += step_sent
+                after_id = step.last_id
+                await db.save_delivery_cursor(chat_id, category_id, after_id)
+            await db.clear_delivery_cursor(chat_id, category_id)
+        else:
+            while True:
+                # یک ردیف اضافه فقط برای دانستن وجود صفحه بعد خوانده می‌شود
+                files = await db.get_files_page(category_id, after_id, DELIVERY_PAGE_SIZE + 1)
+                if not files:
+                    await db.clear_delivery_cursor(chat_id, category_id)
+                    break
+                has_next = len(files) > DELIVERY_PAGE_SIZE
+                
+                for step in compile_delivery_steps(files[:DELIVERY_PAGE_SIZE]):
+                    step_sent = await send_delivery_step(bot, chat_id, step)
+                    metrics.inc('bot_files_delivered_total', step_sent)
+                    sent += step_sent
+                    after_id = step.last_id
+                    await db.save_delivery_cursor(chat_id, category_id, after_id)
+                
+                if not has_next:
+                    await db.clear_delivery_cursor(chat_id, category_id)
+                    break
                 
-                if send_func:
-                    await send_func(
-                        chat_id=chat_id,
-                        **{file['file_type']: file['file_id']},
-                        caption=file.get('caption', '')[:1024]
+                if DELIVERY_PAGE_BUTTON:
+                    keyboard = [[InlineKeyboardButton("📥 ارسال صفحه بعد", callback_data=f"next_{category_id}")]]
+                    await delivery.send(
+                        chat_id,
+                        bot.send_message,
+                        chat_id,
+                        "برای دریافت ادامه فایل‌ها دکمه زیر را بزنید:",
+                        reply_markup=InlineKeyboardMarkup(keyboard)
                     )
-                await asyncio.sleep(0.5)  # افزایش تاخیر برای جلوگیری از محدودیت
-            except Exception as e:
-                logger.error(f"ارسال فایل خطا: {e}")
-                await asyncio.sleep(2)
-    except Exception as e:
-        logger.error(f"خطا در ارسال فایل‌ها: {e}")
-        await message.reply_text("❌ خطایی در ارسال فایل‌ها رخ داد")
+                    break
+        
+        elapsed = time.monotonic() - started_at
+        logger.info(f"📦 {sent} فایل از دسته {category_id} در {elapsed:.1f} ثانیه به {chat_id} ارسال شد")
+    finally:
+        delivery.active_deliveries -= 1
 
 # ========================
 # ==== ADMIN COMMANDS ====
@@ -431,15 +2325,18 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     category_id = context.args[0]
-    category = await bot_manager.db.get_category(category_id)
+    category = await bot_manager.db.get_category_summary(category_id)
     if not category:
         await update.message.reply_text("❌ دسته یافت نشد!")
         return
     
-    bot_manager.pending_uploads[user_id] = {
-        'category_id': category_id,
-        'files': []
-    }
+    reset_upload_state(user_id)
+    try:
+        await bot_manager.sessions.start_upload(user_id, category_id)
+    except asyncpg.ForeignKeyViolationError:
+        # دسته در همین فاصله حذف شده است
+        await update.message.reply_text("❌ دسته یافت نشد!")
+        return
     
     await update.message.reply_text(
         f"📤 حالت آپلود فعال شد! فایل‌ها را ارسال کنید.\n"
@@ -450,181 +2347,99 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش فایل‌های ارسالی"""
     user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
+    # فقط ادمین‌ها نشست آپلود دارند
+    if not bot_manager.is_admin(user_id):
         return
     
     file_info = bot_manager.extract_file_info(update)
     if not file_info:
-        await update.message.reply_text("❌ نوع فایل پشتیبانی نمی‌شود!")
-        return
-    
-    upload = bot_manager.pending_uploads[user_id]
-    upload['files'].append(file_info)
-    
-    await update.message.reply_text(f"✅ فایل دریافت شد! (تعداد: {len(upload['files'])})")
-
-async def finish_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """پایان آپلود فایل‌ها"""
-    user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
-        await update.message.reply_text("❌ هیچ آپلودی فعال نیست!")
-        return ConversationHandler.END
-    
-    upload = bot_manager.pending_uploads.pop(user_id)
-    if not upload['files']:
-        await update.message.reply_text("❌ فایلی دریافت نشد!")
-        return ConversationHandler.END
-    
-    count = await bot_manager.db.add_files(upload['category_id'], upload['files'])
-    link = bot_manager.generate_link(upload['category_id'])
-    
-    await update.message.reply_text(
-        f"✅ {count} فایل با موفقیت ذخیره شد!\n\n"
-        f"🔗 لینک دسته:\n{link}")
-    return ConversationHandler.END
-
-async def categories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """نمایش لیست دسته‌ها"""
-    if not bot_manager.is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ دسترسی ممنوع!")
+        if await bot_manager.sessions.has_upload(user_id):
+            await update.message.reply_text("❌ نوع فایل پشتیبانی نمی‌شود!")
         return
     
-    categories = await bot_manager.db.get_categories()
-    if not categories:
-        await update.message.reply_text("📂 هیچ دسته‌ای وجود ندارد!")
+    # فایل‌های یک آلبوم با هم ذخیره می‌شوند
+    media_group_id = update.message.media_group_id
+    if media_group_id:
+        key = (user_id, media_group_id)
+        album = bot_manager.pending_albums.setdefault(key, {'files': [], 'message': update.message, 'task': None})
+        album['files'].append(file_info)
+        if album['task']:
+            album['task'].cancel()
+        album['task'] = asyncio.create_task(flush_album_later(key))
         return
     
-    message = "📁 لیست دسته‌ها:\n\n"
-    for cid, name in categories.items():
-        message += f"• {name} [ID: {cid}]\n"
-        message += f"  لینک: {bot_manager.generate_link(cid)}\n\n"
-    
-    await update.message.reply_text(message)
+    # حفظ ترتیب: آلبوم‌های نیمه‌کاره (یا در حال ذخیره) قبل از فایل جدید ذخیره می‌شوند
+    async with upload_lock(user_id):
+        await store_user_albums(user_id)
+        await store_upload_files(user_id, update.message, [file_info])
 
-# ========================
-# === CHANNEL MANAGEMENT ==
-# ========================
+def upload_lock(user_id: int) -> asyncio.Lock:
+    """قفل نوشتن فایل‌های نشست آپلود کاربر"""
+    return bot_manager.upload_locks.setdefault(user_id, asyncio.Lock())
 
-async def add_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """شروع افزودن کانال"""
-    if not bot_manager.is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ دسترسی ممنوع!")
+async def store_upload_files(user_id: int, message: Message, files: list):
+    """ذخیره فایل‌ها در نشست آپلود و به‌روزرسانی پیام وضعیت"""
+    progress = await bot_manager.sessions.add_upload_files(user_id, files)
+    if progress is None:
         return
-    
-    bot_manager.pending_channels[update.effective_user.id] = {}
-    await update.message.reply_text(
-        "لطفا اطلاعات کانال را به ترتیب ارسال کنید:\n\n"
-        "1. آیدی کانال (مثال: -1001234567890)\n"
-        "2. نام کانال\n"
-        "3. لینک دعوت")
-    return WAITING_CHANNEL_INFO
+    await bot_manager.upload_progress.report(user_id, message, progress['file_count'], progress['total_bytes'])
 
-async def handle_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """پردازش اطلاعات کانال"""
-    user_id = update.effective_user.id
-    text = update.message.text.strip()
-    
-    if user_id not in bot_manager.pending_channels:
-        return ConversationHandler.END
-    
-    chan_data = bot_manager.pending_channels[user_id]
-    
-    if 'channel_id' not in chan_data:
-        chan_data['channel_id'] = text
-        await update.message.reply_text("✅ آیدی دریافت شد! لطفا نام کانال را ارسال کنید:")
-        return WAITING_CHANNEL_INFO
-    
-    if 'name' not in chan_data:
-        chan_data['name'] = text
-        await update.message.reply_text("✅ نام دریافت شد! لطفا لینک دعوت را ارسال کنید:")
-        return WAITING_CHANNEL_INFO
-    
-    chan_data['link'] = text
-    success = await bot_manager.db.add_channel(
-        chan_data['channel_id'], 
-        chan_data['name'], 
-        chan_data['link']
-    )
-    
-    del bot_manager.pending_channels[user_id]
-    
-    if success:
-        await update.message.reply_text("✅ کانال با موفقیت افزوده شد!")
-    else:
-        await update.message.reply_text("❌ خطا در افزودن کانال (احتمالا تکراری است)")
-    
-    return ConversationHandler.END
+async def flush_album_later(key: tuple):
+    """ذخیره آلبوم پس از اینکه مدتی فایل جدیدی از آن نرسید"""
+    await asyncio.sleep(UPLOAD_ALBUM_WAIT)
+    # قفل تا پایان ذخیره نگه داشته می‌شود تا فایل‌های بعدی و /finish_upload منتظر این آلبوم بمانند
+    async with upload_lock(key[0]):
+        album = bot_manager.pending_albums.pop(key, None)
+        if album:
+            try:
+                await store_upload_files(key[0], album['message'], album['files'])
+            except Exception as e:
+                logger.error(f"خطا در ذخیره آلبوم: {e}")
 
-async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """حذف کانال"""
-    if not bot_manager.is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ دسترسی ممنوع!")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("لطفا آیدی کانال را مشخص کنید.\nمثال: /remove_channel -1001234567890")
-        return
-    
-    success = await bot_manager.db.delete_channel(context.args[0])
-    await update.message.reply_text(
-        "✅ کانال حذف شد!" if success else "❌ کانال یافت نشد!")
+async def store_user_albums(user_id: int):
+    """ذخیره آلبوم‌های نیمه‌کاره کاربر (با قفل upload_lock گرفته‌شده)"""
+    for key in [k for k in bot_manager.pending_albums if k[0] == user_id]:
+        album = bot_manager.pending_albums.pop(key)
+        album['task'].cancel()
+        await store_upload_files(user_id, album['message'], album['files'])
 
-async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """نمایش لیست کانال‌ها"""
-    if not bot_manager.is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ دسترسی ممنوع!")
-        return
+async def flush_user_albums(user_id: int):
+    """ذخیره فوری آلبوم‌های نیمه‌کاره یک کاربر پس از تمام شدن نوشتن‌های در جریان"""
+    async with upload_lock(user_id):
+        await store_user_albums(user_id)
 
-    if not context.args:
-        await update.message.reply_text("لطفا آیدی دسته را مشخص کنید.\nمثال: /upload CAT_ID")
-        return
-    
-    category_id = context.args[0]
-    category = await bot_manager.db.get_category(category_id)
-    if not category:
-        await update.message.reply_text("❌ دسته یافت نشد!")
-        return
-    
-    bot_manager.pending_uploads[user_id] = {
-        'category_id': category_id,
-        'files': []
-    }
-    
-    await update.message.reply_text(
-        f"📤 حالت آپلود فعال شد! فایل‌ها را ارسال کنید.\n"
-        f"برای پایان: /finish_upload\n"
-        f"برای لغو: /cancel")
-    return UPLOADING
+async def flush_all_albums():
+    """ذخیره همه آلبوم‌های نیمه‌کاره (هنگام توقف ربات)"""
+    for user_id in {key[0] for key in bot_manager.pending_albums}:
+        await flush_user_albums(user_id)
 
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """پردازش فایل‌های ارسالی"""
-    user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
-        return
-    
-    file_info = bot_manager.extract_file_info(update)
-    if not file_info:
-        await update.message.reply_text("❌ نوع فایل پشتیبانی نمی‌شود!")
-        return
-    
-    upload = bot_manager.pending_uploads[user_id]
-    upload['files'].append(file_info)
-    
-    await update.message.reply_text(f"✅ فایل دریافت شد! (تعداد: {len(upload['files'])})")
+def drop_user_albums(user_id: int):
+    """حذف آلبوم‌های نیمه‌کاره یک کاربر بدون ذخیره"""
+    for key in [k for k in bot_manager.pending_albums if k[0] == user_id]:
+        bot_manager.pending_albums.pop(key)['task'].cancel()
+
+def reset_upload_state(user_id: int):
+    """پاک کردن وضعیت محلی نشست قبلی کاربر (آلبوم‌های نیمه‌کاره و پیام وضعیت) هنگام شروع یا لغو نشست"""
+    drop_user_albums(user_id)
+    bot_manager.upload_progress.clear(user_id)
 
 async def finish_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پایان آپلود فایل‌ها"""
     user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
+    # نشست پس از ذخیره شدن آلبوم‌های نیمه‌کاره و در حال ذخیره بسته می‌شود
+    async with upload_lock(user_id):
+        await store_user_albums(user_id)
+        bot_manager.upload_progress.clear(user_id)
+        upload = await bot_manager.sessions.finish_upload(user_id)
+    if upload is None:
         await update.message.reply_text("❌ هیچ آپلودی فعال نیست!")
         return ConversationHandler.END
     
-    upload = bot_manager.pending_uploads.pop(user_id)
-    if not upload['files']:
+    if not upload['staged']:
         await update.message.reply_text("❌ فایلی دریافت نشد!")
         return ConversationHandler.END
     
-    count = await bot_manager.db.add_files(upload['category_id'], upload['files'])
+    count = upload['inserted']
     link = bot_manager.generate_link(upload['category_id'])
     
     await update.message.reply_text(
@@ -633,22 +2448,60 @@ async def finish_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def categories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """نمایش لیست دسته‌ها"""
+    """نمایش صفحه اول دسته‌ها (با امکان جستجو بر اساس ابتدای نام)"""
     if not bot_manager.is_admin(update.effective_user.id):
         await update.message.reply_text("❌ دسترسی ممنوع!")
         return
     
-    categories = await bot_manager.db.get_categories()
+    # پیشوند در callback_data صفحه‌های بعد تکرار می‌شود (حداکثر ۶۴ بایت)، پس از همین ابتدا کوتاه می‌شود
+    prefix = ' '.join(context.args).encode()[:40].decode(errors='ignore') if context.args else ''
+    categories, has_next = await bot_manager.db.get_categories_page(CATEGORIES_PAGE_SIZE, prefix=prefix)
     if not categories:
-        await update.message.reply_text("📂 هیچ دسته‌ای وجود ندارد!")
+        await update.message.reply_text(
+            "📂 دسته‌ای با این نام یافت نشد!" if prefix else "📂 هیچ دسته‌ای وجود ندارد!")
         return
     
-    message = "📁 لیست دسته‌ها:\n\n"
-    for cid, name in categories.items():
-        message += f"• {name} [ID: {cid}]\n"
-        message += f"  لینک: {bot_manager.generate_link(cid)}\n\n"
+    text, markup = render_categories_page(categories, False, has_next, prefix)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def browse_categories(query, direction: str, cursor_id: str, prefix: str):
+    """نمایش صفحه قبل یا بعد دسته‌ها با ویرایش همان پیام"""
+    if direction == 'next':
+        categories, has_next = await bot_manager.db.get_categories_page(
+            CATEGORIES_PAGE_SIZE, after_id=cursor_id, prefix=prefix)
+        has_prev = True
+    else:
+        categories, has_prev = await bot_manager.db.get_categories_page(
+            CATEGORIES_PAGE_SIZE, before_id=cursor_id, prefix=prefix)
+        has_next = True
     
-    await update.message.reply_text(message)
+    if not categories:
+        # دسته‌های این صفحه در این فاصله حذف شده‌اند
+        await query.edit_message_text("📂 صفحه دیگری وجود ندارد! دوباره /categories را بزنید.")
+        return
+    
+    text, markup = render_categories_page(categories, has_prev, has_next, prefix)
+    await query.edit_message_text(text, reply_markup=markup)
+
+def render_categories_page(categories: list, has_prev: bool, has_next: bool, prefix: str) -> tuple:
+    """ساخت متن و دکمه‌های یک صفحه از لیست دسته‌ها"""
+    message = f"📁 دسته‌های «{prefix}»:\n\n" if prefix else "📁 لیست دسته‌ها:\n\n"
+    keyboard = []
+    for category in categories:
+        cid = category['id']
+        message += f"• {category['name']} [ID: {cid}]\n"
+        message += f"  فایل‌ها: {category['file_count']} ({format_size(category['total_bytes'])})\n"
+        message += f"  لینک: {bot_manager.generate_link(cid)}\n\n"
+        keyboard.append([InlineKeyboardButton(f"📂 {category['name']}", callback_data=f"menu_{cid}")])
+    
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"catprev_{categories[0]['id']}_{prefix}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"catnext_{categories[-1]['id']}_{prefix}"))
+    if nav:
+        keyboard.append(nav)
+    return message, InlineKeyboardMarkup(keyboard)
 
 # ========================
 # === CHANNEL MANAGEMENT ==
@@ -660,7 +2513,7 @@ async def add_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ دسترسی ممنوع!")
         return
     
-    bot_manager.pending_channels[update.effective_user.id] = {}
+    await bot_manager.sessions.set_channel_session(update.effective_user.id, {})
     await update.message.reply_text(
         "لطفا اطلاعات کانال را به ترتیب ارسال کنید:\n\n"
         "1. آیدی کانال (مثال: -1001234567890)\n"
@@ -673,18 +2526,19 @@ async def handle_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     text = update.message.text.strip()
     
-    if user_id not in bot_manager.pending_channels:
+    chan_data = await bot_manager.sessions.get_channel_session(user_id)
+    if chan_data is None:
         return ConversationHandler.END
     
-    chan_data = bot_manager.pending_channels[user_id]
-    
     if 'channel_id' not in chan_data:
         chan_data['channel_id'] = text
+        await bot_manager.sessions.set_channel_session(user_id, chan_data)
         await update.message.reply_text("✅ آیدی دریافت شد! لطفا نام کانال را ارسال کنید:")
         return WAITING_CHANNEL_INFO
     
     if 'name' not in chan_data:
         chan_data['name'] = text
+        await bot_manager.sessions.set_channel_session(user_id, chan_data)
         await update.message.reply_text("✅ نام دریافت شد! لطفا لینک دعوت را ارسال کنید:")
         return WAITING_CHANNEL_INFO
     
@@ -695,7 +2549,7 @@ async def handle_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE
         chan_data['link']
     )
     
-    del bot_manager.pending_channels[user_id]
+    await bot_manager.sessions.clear_channel_session(user_id)
     
     if success:
         await update.message.reply_text("✅ کانال با موفقیت افزوده شد!")
@@ -704,6 +2558,14 @@ async def handle_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     return ConversationHandler.END
 
+async def resume_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ادامه افزودن کانال از نشست ذخیره‌شده (پس از ری‌استارت یا روی نمونه دیگر ربات)"""
+    user_id = update.effective_user.id
+    if not bot_manager.is_admin(user_id):
+        return
+    if await bot_manager.sessions.get_channel_session(user_id) is not None:
+        await handle_channel_info(update, context)
+
 async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """حذف کانال"""
     if not bot_manager.is_admin(update.effective_user.id):
@@ -743,49 +2605,67 @@ async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # === BUTTON HANDLERS ====
 # ========================
 
+async def recheck_membership(query, context, category_id: str):
+    """بررسی مجدد عضویت پس از زدن دکمه "عضو شدم" و ثبت ارسال فایل‌ها"""
+    user_id = query.from_user.id
+    
+    # بررسی مجدد عضویت
+    channels = await bot_manager.db.get_channels()
+    non_joined = await get_non_joined_channels(context, channels, user_id, recheck=True)
+    
+    if non_joined:
+        # هنوز در برخی کانال‌ها عضو نیست
+        keyboard = []
+        for channel in non_joined:
+            button = InlineKeyboardButton(
+                text=f"📢 {channel['channel_name']}",
+                url=channel['invite_link']
+            )
+            keyboard.append([button])
+        
+        keyboard.append([
+            InlineKeyboardButton(
+                "✅ عضو شدم", 
+                callback_data=f"check_{category_id}"
+            )
+        ])
+        
+        await query.edit_message_text(
+            "⚠️ هنوز در کانال‌های زیر عضو نشده‌اید:",
+            reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        # حالا عضو شده است
+        await query.edit_message_text("✅ عضویت شما تأیید شد! در حال آماده‌سازی فایل‌ها...")
+        await queue_category_delivery(query.message, category_id)
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت کلیک روی دکمه‌ها"""
     query = update.callback_query
-    await query.answer()
     data = query.data
     
     # بررسی عضویت در کانال‌ها
     if data.startswith('check_'):
         category_id = data[6:]
         user_id = query.from_user.id
-        
-        # بررسی مجدد عضویت
-        channels = await bot_manager.db.get_channels()
-        non_joined = []
-        for channel in channels:
-            is_member = await is_user_member(context, channel['channel_id'], user_id)
-            if not is_member:
-                non_joined.append(channel)
-        
-        if non_joined:
-            # هنوز در برخی کانال‌ها عضو نیست
-            keyboard = []
-            for channel in non_joined:
-                button = InlineKeyboardButton(
-                    text=f"📢 {channel['channel_name']}",
-                    url=channel['invite_link']
-                )
-                keyboard.append([button])
-            
-            keyboard.append([
-                InlineKeyboardButton(
-                    "✅ عضو شدم", 
-                    callback_data=f"check_{category_id}"
-                )
-            ])
-            
-            await query.edit_message_text(
-                "⚠️ هنوز در کانال‌های زیر عضو نشده‌اید:",
-                reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            # حالا عضو شده است
-            await query.edit_message_text("✅ عضویت شما تأیید شد! در حال آماده‌سازی فایل‌ها...")
-            await send_category_files(query.message, context, category_id)
+        if not bot_manager.allow_user(user_id):
+            await query.answer("⏳ لطفا کمی صبر کنید و دوباره تلاش کنید.")
+            return
+        await query.answer()
+        await bot_manager.coalesce(
+            user_id, category_id, lambda: recheck_membership(query, context, category_id))
+        return
+    
+    await query.answer()
+    
+    # ادامه ارسال صفحه بعد (با بررسی مجدد عضویت برای کاربران عادی)
+    if data.startswith('next_'):
+        category_id = data[5:]
+        user_id = query.from_user.id
+        if bot_manager.is_admin(user_id):
+            await queue_category_delivery(query.message, category_id)
+        elif bot_manager.allow_user(user_id):
+            await bot_manager.coalesce(
+                user_id, category_id, lambda: handle_category(update, context, category_id))
         return
     
     # دستورات ادمین
@@ -794,16 +2674,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ دسترسی ممنوع!")
         return
     
-    if data.startswith('view_'):
+    if data.startswith(('catnext_', 'catprev_')):
+        action, cursor_id, prefix = data.split('_', 2)
+        await browse_categories(query, action[3:], cursor_id, prefix)
+    
+    elif data.startswith('menu_'):
+        await admin_category_menu(query.message, data[5:])
+    
+    elif data.startswith('view_'):
         category_id = data[5:]
-        await send_category_files(query.message, context, category_id)
+        await queue_category_delivery(query.message, category_id)
     
     elif data.startswith('add_'):
         category_id = data[4:]
-        bot_manager.pending_uploads[user_id] = {
-            'category_id': category_id,
-            'files': []
-        }
+        reset_upload_state(user_id)
+        try:
+            await bot_manager.sessions.start_upload(user_id, category_id)
+        except asyncpg.ForeignKeyViolationError:
+            await query.edit_message_text("❌ دسته یافت نشد!")
+            return
         await query.edit_message_text(
             "📤 فایل‌ها را ارسال کنید.\n"
             "برای پایان: /finish_upload\n"
@@ -811,14 +2700,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('delcat_'):
         category_id = data[7:]
-        category = await bot_manager.db.get_category(category_id)
+        category = await bot_manager.db.get_category_summary(category_id)
         if not category:
             await query.edit_message_text("❌ دسته یافت نشد!")
             return
         
         # حذف دسته
-        async with bot_manager.db.pool.acquire() as conn:
-            await conn.execute("DELETE FROM categories WHERE id = $1", category_id)
+        await bot_manager.db.delete_category(category_id)
         
         await query.edit_message_text(f"✅ دسته '{category['name']}' حذف شد!")
 
@@ -829,10 +2717,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """لغو عملیات جاری"""
     user_id = update.effective_user.id
-    if user_id in bot_manager.pending_uploads:
-        del bot_manager.pending_uploads[user_id]
-    if user_id in bot_manager.pending_channels:
-        del bot_manager.pending_channels[user_id]
+    reset_upload_state(user_id)
+    await bot_manager.sessions.cancel_upload(user_id)
+    await bot_manager.sessions.clear_channel_session(user_id)
     
     await update.message.reply_text("❌ عملیات لغو شد.")
     return ConversationHandler.END
@@ -841,48 +2728,381 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # === WEB SERVER SETUP ===
 # ========================
 
+async def expire_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    """حذف دوره‌ای نشست‌های رها‌شده"""
+    try:
+        expired = await bot_manager.sessions.expire_sessions()
+        if expired:
+            logger.info(f"🧹 {expired} نشست منقضی حذف شد")
+    except Exception as e:
+        logger.warning(f"خطا در حذف نشست‌های منقضی: {e}")
+
 async def health_check(request):
-    """صفحه سلامت برای بررسی وضعیت ربات"""
-    return web.Response(text="🤖 Telegram Bot is Running!")
+    """صفحه سلامت: آمادگی دیتابیس و میزان اشغال pool"""
+    db_status = await bot_manager.db.health()
+    return web.json_response(
+        {'status': 'ok' if db_status['ready'] else 'degraded', 'db': db_status},
+        status=200 if db_status['ready'] else 503
+    )
+
+def is_telegram_request(request) -> bool:
+    """بررسی توکن مخفی وبهوک با مقایسه زمان‌ثابت"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    return hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
+
+async def telegram_webhook(request):
+    """دریافت آپدیت‌های تلگرام و قرار دادن در صف Application"""
+    if not is_telegram_request(request):
+        return web.Response(status=403)
+    
+    application = bot_manager.application
+    if application is None:
+        # ربات هنوز آماده نیست؛ تلگرام درخواست را دوباره ارسال می‌کند
+        return web.Response(status=503)
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+async def metrics_endpoint(request):
+    """خروجی متریک‌ها با فرمت Prometheus"""
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+def is_debug_authorized(request) -> bool:
+    """بررسی توکن ادمین برای مسیرهای /debug"""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(token, DEBUG_TOKEN)
+
+profile_lock = asyncio.Lock()
+
+async def profile_endpoint(request):
+    """نمونه‌برداری از پشته event loop به مدت چند ثانیه؛ خروجی با فرمت folded (قابل استفاده در flamegraph)"""
+    if not is_debug_authorized(request):
+        return web.Response(status=403)
+    try:
+        seconds = min(float(request.query.get('seconds', '10')), 60)
+        interval = max(float(request.query.get('interval', '0.005')), 0.001)
+    except ValueError:
+        return web.Response(status=400)
+    if profile_lock.locked():
+        return web.Response(status=409, text="profile already running")
+    
+    async with profile_lock:
+        # نمونه‌برداری در thread جدا انجام می‌شود تا event loop به کار خود ادامه دهد
+        samples = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+    lines = [f"{stack} {count}" for stack, count in sorted(samples.items(), key=lambda item: -item[1])]
+    return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+async def slow_updates_endpoint(request):
+    """آخرین trace آپدیت‌های کند"""
+    if not is_debug_authorized(request):
+        return web.Response(status=403)
+    return web.json_response(list(slow_traces))
+
+@web.middleware
+async def track_activity(request, handler):
+    """ثبت زمان آخرین ترافیک واقعی برای رد کردن پینگ‌های غیرضروری"""
+    if 'X-Keep-Alive' not in request.headers:
+        bot_manager.last_activity = time.monotonic()
+    return await handler(request)
 
 async def keep_alive():
-    """ارسال درخواست به health endpoint هر 5 دقیقه"""
+    """پینگ دوره‌ای سرویس با session مشترک؛ اگر ترافیک اخیر وجود داشته باشد پینگ لازم نیست"""
+    if not KEEP_ALIVE_URL:
+        return
+    
     while True:
+        # فاصله تصادفی تا پینگ چند نمونه همزمان نشود
+        await asyncio.sleep(KEEP_ALIVE_INTERVAL * random.uniform(1 - KEEP_ALIVE_JITTER, 1 + KEEP_ALIVE_JITTER))
+        if time.monotonic() - bot_manager.last_activity < KEEP_ALIVE_INTERVAL:
+            continue
+        
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get("https://uploader-bot-ely6.onrender.com") as resp:
-                    if resp.status == 200:
-                        logger.info("✅ Keep-alive ping sent successfully")
-                    else:
-                        logger.warning(f"⚠️ Keep-alive failed: {resp.status}")
+            async with bot_manager.http.get().get(KEEP_ALIVE_URL, headers={'X-Keep-Alive': '1'}) as resp:
+                if resp.status == 200:
+                    logger.info("✅ Keep-alive ping sent successfully")
+                else:
+                    logger.warning(f"⚠️ Keep-alive failed: {resp.status}")
         except Exception as e:
             logger.warning(f"⚠️ Keep-alive exception: {e}")
-        
-        await asyncio.sleep(450)  # هر ۵ دقیقه (۳۰۰ ثانیه)
 
-
-async def run_web_server():
-    """اجرای سرور وب ساده"""
-    app = web.Application()
-    app.router.add_get('/health', health_check)
+async def start_site(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """اجرای یک اپلیکیشن aiohttp روی آدرس مشخص"""
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 10000)
+    site = web.TCPSite(runner, host, port)
     await site.start()
-    logger.info("Web server started at port 10000")
+    logger.info(f"Web server started at {host}:{port}")
+    return runner
+
+async def run_web_server():
+    """اجرای سرور وب ساده (در حالت worker بدون وبهوک و در حالت shard فقط روی 127.0.0.1 برای آپدیت‌های supervisor)"""
+    app = web.Application(middlewares=[track_activity])
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_endpoint)
+    if DEBUG_TOKEN:
+        app.router.add_get('/debug/profile', profile_endpoint)
+        app.router.add_get('/debug/slow-updates', slow_updates_endpoint)
+    if BOT_MODE == 'shard':
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+        return await start_site(app, '127.0.0.1', SHARD_BASE_PORT + SHARD_INDEX)
+    if WEBHOOK_URL and BOT_MODE != 'worker':
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return await start_site(app, '0.0.0.0', WEB_PORT)
+
+def update_shard_key(data: dict) -> int:
+    """شناسه کاربر آپدیت برای انتخاب shard (برای chat_member خود عضو، نه ادمین انجام‌دهنده)"""
+    member_update = data.get('chat_member')
+    if member_update:
+        return member_update['new_chat_member']['user']['id']
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if sender:
+                return sender.get('id', 0)
+    return 0
+
+def merge_shard_metrics(outputs: list) -> str:
+    """ادغام خروجی /metrics چند shard با افزودن برچسب shard؛ HELP و TYPE هر متریک یک بار نوشته می‌شود"""
+    families = {}  # {name: (header lines, samples)}
+    for index, text in outputs:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = families.setdefault(line.split()[2], ([], []))
+                if len(family[0]) < 2:
+                    family[0].append(line)
+                continue
+            if not line or family is None:
+                continue
+            series, value = line.rsplit(' ', 1)
+            if series.endswith('}'):
+                series = f'{series[:-1]},shard="{index}"}}'
+            else:
+                series = f'{series}{{shard="{index}"}}'
+            family[1].append(f"{series} {value}")
+    
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+class Supervisor:
+    """اجرای چند پروسه ربات و تقسیم آپدیت‌های وبهوک بین آن‌ها؛ آپدیت‌های هر کاربر همیشه به یک پروسه می‌رسند"""
+    
+    def __init__(self, processes: int):
+        self.processes = [None] * processes
+        self.tasks = []
+        self.stopping = False
+    
+    async def start(self) -> web.AppRunner:
+        """اجرای پروسه‌ها، ثبت وبهوک و سرور وب عمومی"""
+        if not WEBHOOK_URL:
+            raise RuntimeError("BOT_MODE=supervisor requires WEBHOOK_URL")
+        
+        for index in range(len(self.processes)):
+            self.tasks.append(asyncio.create_task(self._watch(index)))
+        
+        bot = Bot(BOT_TOKEN)
+        await bot.initialize()
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await bot.shutdown()
+        logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}, routing to {len(self.processes)} shard(s)")
+        
+        app = web.Application(middlewares=[track_activity])
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/metrics', self.metrics)
+        if DEBUG_TOKEN:
+            app.router.add_get('/debug/profile', self.proxy_debug)
+            app.router.add_get('/debug/slow-updates', self.proxy_debug)
+        app.router.add_post(WEBHOOK_PATH, self.route_update)
+        return await start_site(app, '0.0.0.0', WEB_PORT)
+    
+    async def _watch(self, index: int):
+        """اجرای یک shard و راه‌اندازی مجدد آن در صورت خروج ناخواسته"""
+        env = dict(os.environ, BOT_MODE='shard', SHARD_INDEX=str(index), BOT_PROCESSES=str(len(self.processes)))
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.processes[index] = process
+            code = await process.wait()
+            if self.stopping:
+                break
+            logger.error(f"Shard {index} exited with code {code}, restarting in 5s")
+            await asyncio.sleep(5)
+    
+    async def route_update(self, request):
+        """ارسال آپدیت به shard کاربر بر اساس شناسه او"""
+        if not is_telegram_request(request):
+            return web.Response(status=403)
+        
+        body = await request.read()
+        try:
+            index = update_shard_key(json.loads(body)) % len(self.processes)
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        
+        try:
+            async with bot_manager.http.get().post(
+                f"http://127.0.0.1:{SHARD_BASE_PORT + index}{WEBHOOK_PATH}",
+                data=body,
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET
+                }
+            ) as resp:
+                return web.Response(status=resp.status)
+        except aiohttp.ClientError:
+            # shard در حال راه‌اندازی است؛ تلگرام آپدیت را دوباره ارسال می‌کند
+            return web.Response(status=503)
+    
+    async def metrics(self, request):
+        """متریک‌های همه shardها با برچسب shard (shardهای در دسترس نیامده حذف می‌شوند)"""
+        async def fetch(index):
+            async with bot_manager.http.get().get(f"http://127.0.0.1:{SHARD_BASE_PORT + index}/metrics") as resp:
+                return index, await resp.text()
+        
+        results = await asyncio.gather(*(fetch(index) for index in range(len(self.processes))), return_exceptions=True)
+        outputs = [result for result in results if not isinstance(result, BaseException)]
+        return web.Response(text=merge_shard_metrics(outputs), content_type='text/plain', charset='utf-8')
+    
+    async def proxy_debug(self, request):
+        """ارسال درخواست /debug به یک shard (پارامتر shard، پیش‌فرض 0)"""
+        if not is_debug_authorized(request):
+            return web.Response(status=403)
+        try:
+            index = int(request.query.get('shard', '0'))
+        except ValueError:
+            return web.Response(status=400)
+        if not 0 <= index < len(self.processes):
+            return web.Response(status=400)
+        
+        params = {key: value for key, value in request.query.items() if key != 'shard'}
+        try:
+            async with bot_manager.http.get().get(
+                f"http://127.0.0.1:{SHARD_BASE_PORT + index}{request.path}",
+                params=params,
+                headers={'Authorization': request.headers['Authorization']},
+                # نمونه‌برداری پروفایل تا 60 ثانیه طول می‌کشد
+                timeout=aiohttp.ClientTimeout(total=90)
+            ) as resp:
+                return web.Response(
+                    status=resp.status, body=await resp.read(), content_type=resp.content_type, charset=resp.charset)
+        except aiohttp.ClientError:
+            return web.Response(status=503)
+    
+    async def health(self, request):
+        """وضعیت پروسه‌های shard"""
+        alive = [process is not None and process.returncode is None for process in self.processes]
+        return web.json_response(
+            {'status': 'ok' if all(alive) else 'degraded', 'shards': alive},
+            status=200 if all(alive) else 503
+        )
     
-    # اجرای نامحدود
-    while True:
-        await asyncio.sleep(3600)
+    async def stop(self):
+        """ارسال SIGTERM به shardها و انتظار برای توقف مرتب آن‌ها"""
+        self.stopping = True
+        running = [process for process in self.processes if process and process.returncode is None]
+        for process in running:
+            process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(process.wait() for process in running)), SHUTDOWN_TIMEOUT + 15)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
 # ========================
 # ==== BOT SETUP =========
 # ========================
 
-async def run_telegram_bot():
-    """اجرای اصلی ربات تلگرام"""
-    application = Application.builder().token(BOT_TOKEN).build()
+class InstrumentedRequest(HTTPXRequest):
+    """درخواست HTTP به Bot API همراه با ثبت زمان پاسخ و خطاها"""
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started_at = time.perf_counter()
+        try:
+            async with Span(f"api.{api_method}"):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_telegram_errors_total', method=api_method, status='network')
+            raise
+        finally:
+            metrics.observe('bot_telegram_request_seconds', time.perf_counter() - started_at, method=api_method)
+        
+        if code == 429:
+            metrics.inc('bot_telegram_retry_after_total', method=api_method)
+        elif code >= 400:
+            metrics.inc('bot_telegram_errors_total', method=api_method, status=str(code))
+        return code, payload
+
+def track_handler(label: str, callback):
+    """ثبت زمان اجرای هندلر؛ برای دکمه‌ها برچسب از پیشوند callback_data گرفته می‌شود"""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        name = label
+        if name is None:
+            data = update.callback_query.data if update.callback_query else ''
+            name = data.split('_', 1)[0] + '_' if '_' in data else (data or 'callback')
+        started_at = time.perf_counter()
+        trace = UpdateTrace(name, update) if PROFILE_UPDATES else None
+        token = current_trace.set(trace)
+        try:
+            return await callback(update, context)
+        finally:
+            current_trace.reset(token)
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started_at, handler=name)
+            if trace:
+                trace.finish()
+    return wrapper
+
+def instrument_handlers(application: Application):
+    """افزودن ثبت زمان به همه هندلرهای ثبت‌شده (شامل هندلرهای داخل گفتگوها)"""
+    def instrument(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                instrument(inner)
+            for state_handlers in handler.states.values():
+                for inner in state_handlers:
+                    instrument(inner)
+            return
+        
+        if isinstance(handler, CommandHandler):
+            label = sorted(handler.commands)[0]
+        elif isinstance(handler, CallbackQueryHandler):
+            label = None
+        else:
+            label = handler.callback.__name__
+        handler.callback = track_handler(label, handler.callback)
     
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+
+def build_application() -> Application:
+    """ساخت Application؛ پیش از راه‌اندازی ساخته می‌شود تا در صورت خطای راه‌اندازی هم بسته شود"""
+    builder = Application.builder().token(BOT_TOKEN).request(
+        InstrumentedRequest(connection_pool_size=256))
+    if WEBHOOK_URL or BOT_MODE == 'shard':
+        # آپدیت‌ها از طریق سرور وب دریافت می‌شوند و نیازی به Updater نیست
+        builder = builder.updater(None)
+    return builder.build()
+
+async def run_telegram_bot(application: Application):
+    """اجرای اصلی ربات تلگرام"""
     # دریافت یوزرنیم ربات
     await application.initialize()
     bot = await application.bot.get_me()
@@ -890,8 +3110,8 @@ async def run_telegram_bot():
     logger.info(f"Bot username: @{bot_username}")
     await bot_manager.init(bot_username)
     
-    # دستورات اصلی
-    application.add_handler(CommandHandler("start", start))
+    # دستورات اصلی (start و دکمه‌ها غیرمسدودکننده‌اند تا ارسال‌های چند کاربر همزمان انجام شود)
+    application.add_handler(CommandHandler("start", start, block=False))
     application.add_handler(CommandHandler("new_category", new_category))
     application.add_handler(CommandHandler("categories", categories_list))
     
@@ -929,28 +3149,122 @@ async def run_telegram_bot():
         fallbacks=[CommandHandler("cancel", cancel)]
     )
     application.add_handler(channel_handler)
+    # وضعیت ConversationHandler در حافظه است؛ نشست ذخیره‌شده کانال با این هندلر ادامه می‌یابد
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, resume_channel_info))
     application.add_handler(CommandHandler("remove_channel", remove_channel))
     application.add_handler(CommandHandler("channels", list_channels))
     
     # دکمه‌های اینلاین
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(button_handler, block=False))
+    
+    # ورود و خروج اعضای کانال‌ها
+    if MEMBERSHIP_UPDATES:
+        application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    
+    # پاکسازی نشست‌های رها‌شده
+    application.job_queue.run_repeating(expire_sessions_job, interval=600, first=60)
+    
+    # متریک‌ها
+    instrument_handlers(application)
     
     # اجرای ربات
     logger.info("Starting Telegram bot...")
     await application.start()
-    await application.updater.start_polling()
-    
-    # نگه داشتن ربات در حالت اجرا
-    while True:
-        await asyncio.sleep(3600)
+    bot_manager.application = application
+    bot_manager.deliveries.start(application.bot, deliver_category)
+    if BOT_MODE == 'shard':
+        # وبهوک توسط supervisor ثبت شده است
+        logger.info(f"Shard {SHARD_INDEX} ready")
+    elif WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+    else:
+        # آپدیت‌های chat_member فقط با درخواست صریح ارسال می‌شوند
+        await application.updater.start_polling(
+            allowed_updates=Update.ALL_TYPES if MEMBERSHIP_UPDATES else None)
+
+async def run_delivery_worker(bot: Bot):
+    """پروسه مستقل تخلیه صف ارسال (BOT_MODE=worker) بدون دریافت آپدیت"""
+    await bot.initialize()
+    await bot_manager.init(bot.username)
+    bot_manager.deliveries.start(bot, deliver_category)
+
+async def shutdown_step(name: str, func, *args):
+    """اجرای یک مرحله توقف؛ خطای هر مرحله مانع مراحل بعدی نمی‌شود"""
+    try:
+        await func(*args)
+        logger.info(f"🛑 {name} stopped")
+    except Exception as e:
+        logger.error(f"خطا در توقف {name}: {e}")
+
+async def stop_intake(application: Application):
+    """توقف دریافت آپدیت؛ در حالت وبهوک تلگرام آپدیت‌های رد شده را دوباره ارسال می‌کند"""
+    bot_manager.application = None
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+
+async def stop_application(application: Application):
+    """انتظار برای هندلرهای در حال اجرا و بستن Application"""
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+async def shutdown(application, bot, runner, tasks: list, supervisor: Supervisor = None):
+    """توقف مرتب: دریافت آپدیت، ارسال‌های در جریان، Application، دیتابیس، HTTP و سرور وب"""
+    for task in tasks:
+        task.cancel()
+    if supervisor:
+        await shutdown_step('shards', supervisor.stop)
+    if application:
+        await shutdown_step('update intake', stop_intake, application)
+    await shutdown_step('album buffers', flush_all_albums)
+    await shutdown_step('delivery workers', bot_manager.deliveries.stop, SHUTDOWN_TIMEOUT)
+    if application:
+        await shutdown_step('application', stop_application, application)
+    elif bot:
+        await shutdown_step('bot', bot.shutdown)
+    await shutdown_step('database pool', bot_manager.db.close)
+    await shutdown_step('http client', bot_manager.http.close)
+    if runner:
+        await shutdown_step('web server', runner.cleanup)
 
 async def main():
-    """اجرای همزمان سرور وب و ربات تلگرام"""
-    await asyncio.gather(
-        run_web_server(),
-        run_telegram_bot(),
-        keep_alive()
-    )
+    """اجرای سرور وب و ربات تلگرام تا دریافت SIGTERM/SIGINT و سپس توقف مرتب"""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stopping.set)
+    
+    application = bot = runner = supervisor = None
+    tasks = []
+    try:
+        if BOT_MODE == 'worker':
+            runner = await run_web_server()
+            bot = Bot(BOT_TOKEN, request=InstrumentedRequest(connection_pool_size=256))
+            await run_delivery_worker(bot)
+        elif BOT_MODE == 'supervisor':
+            supervisor = Supervisor(BOT_PROCESSES)
+            runner = await supervisor.start()
+            tasks.append(asyncio.create_task(keep_alive()))
+        elif BOT_MODE == 'shard':
+            runner = await run_web_server()
+            application = build_application()
+            await run_telegram_bot(application)
+        else:
+            runner = await run_web_server()
+            application = build_application()
+            await run_telegram_bot(application)
+            tasks.append(asyncio.create_task(keep_alive()))
+        
+        await stopping.wait()
+        logger.info("Stop signal received, shutting down...")
+    finally:
+        await shutdown(application, bot, runner, tasks, supervisor)
 
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()